@@ -1,14 +1,28 @@
+import argparse
+import json
+import mmap
+import os
 import re
+import struct
 import sys
+from array import array
+from bisect import bisect_right
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from enum import IntEnum
+from functools import lru_cache
+from itertools import chain
 from pathlib import Path
-from typing import Tuple, Optional, TextIO
+from typing import Optional, TextIO, List, Iterable, Iterator, Union, Dict, Tuple
 
 from BaseUtils import BaseParser
 
 SYMBOL_PATTERN = re.compile(r'[a-zA-Z_.$:][0-9a-zA-Z_.$:]*')
-COMP_PATTERN = re.compile(r'([AMD]*=)?(?P<comp>[ADM+\-&!01|]+)(;[A-Z]+)?')
+FUNCTION_LABEL_PATTERN = re.compile(r'[a-zA-Z_][0-9a-zA-Z_]*\.[a-zA-Z_][0-9a-zA-Z_]*')  # vm函数生成的标签 Class.method
+ROM_SIZE = 32768
+C_COMMAND_CACHE_SIZE = 4096
+# 指令数少于此值时多进程的启动和传输开销大于收益: 进程池启动约30ms, 约等于单进程编码1.6万条指令的时间
+PARALLEL_MIN_INSTRUCTIONS = ROM_SIZE // 2
 
 
 class CommandType(IntEnum):
@@ -56,153 +70,561 @@ class SymbolTable:
         return self.table[symbol]
 
 
+class Instruction:
+    """ 预解码后的指令记录, 每行只解析一次, dest/comp/jump 为整数操作码"""
+    __slots__ = ("command_type", "symbol", "dest", "comp", "jump", "word")
+
+    def __init__(self, command_type: CommandType, symbol: Optional[str] = None,
+                 dest: int = 0, comp: int = 0, jump: int = 0, word: int = 0):
+        self.command_type = command_type
+        self.symbol = symbol      # A指令的符号 / L指令的标签, 数字地址的A指令为None
+        self.dest = dest
+        self.comp = comp
+        self.jump = jump
+        self.word = word          # 16位机器码, 带符号的A指令要等符号解析后才能确定
+
+
+class SourceLine(str):
+    """ 带源位置的指令文本, 只在生成源码映射时使用; 窥孔优化等改写产生的普通字符串沿用前一条指令的位置"""
+
+    def __new__(cls, cmd: str, line: int, vm_command: Optional[str]):
+        source_line = super().__new__(cls, cmd)
+        source_line.line = line
+        source_line.vm_command = vm_command
+        return source_line
+
+
 class Parser(BaseParser):
+    VM_COMMAND_PREFIX = "// vm command:"
 
-    def __init__(self, asm_object: TextIO):
+    def __init__(self, asm_object: TextIO, track_source: bool = False):
         super().__init__(asm_object)
         self.current_cmd = None
+        self.track_source = track_source
+        self.vm_command: Optional[str] = None  # 最近一条 // vm command: 注释
+
+    def read_comment(self, comment: str):
+        if comment.startswith(self.VM_COMMAND_PREFIX):
+            self.vm_command = comment[len(self.VM_COMMAND_PREFIX):].strip()
 
     def advance(self):
-        self.current_cmd = self.current_line
-
-    @property
-    def command_type(self) -> CommandType:
-        if self.current_cmd.find("@") >= 0:
-            return CommandType.A_COMMAND
-        elif self.current_cmd.find("(") >= 0:
-            return CommandType.L_COMMAND
-        else:
-            return CommandType.C_COMMAND
-
-    @property
-    def symbol(self) -> str:
-        if self.command_type == CommandType.A_COMMAND:
-            return self.current_cmd.split("@")[1]
-        elif self.command_type == CommandType.L_COMMAND:
-            return self.current_cmd[1:-1]
+        if self.track_source:
+            self.current_cmd = SourceLine(self.current_line, self.line_number, self.vm_command)
         else:
-            raise Exception("C_COMMAND cannot get symbol")
+            self.current_cmd = self.current_line
 
-    @property
-    def dest(self) -> Optional[str]:
-        if self.current_cmd.find("=") >= 0:
-            return self.current_cmd.split("=")[0]
-        else:
-            return None
+    def commands(self) -> Iterator[str]:
+        while self.has_more_commands():
+            self.advance()
+            yield self.current_cmd
 
-    @property
-    def comp(self) -> Optional[str]:
-        if match := COMP_PATTERN.match(self.current_cmd):
-            return match.groupdict()['comp']
-        else:
-            print("not find comp!!!")
-            return None
-
-    @property
-    def jump(self) -> Optional[str]:
-        if self.current_cmd.find(";") >= 0:
-            return self.current_cmd.split(";")[1]
+    @classmethod
+    def decode(cls, cmd: str) -> Instruction:
+        if cmd[0] == "@":
+            value = cmd[1:]
+            if SYMBOL_PATTERN.match(value):
+                return Instruction(CommandType.A_COMMAND, symbol=value)
+            return Instruction(CommandType.A_COMMAND, word=int(value))
+        elif cmd[0] == "(":
+            return Instruction(CommandType.L_COMMAND, symbol=cmd[1:-1])
         else:
-            return None
+            return cls.decode_c_command(cmd)
+
+    @staticmethod
+    @lru_cache(maxsize=C_COMMAND_CACHE_SIZE)
+    def decode_c_command(cmd: str) -> Instruction:
+        """
+            生成的代码里不同的C指令只有几十种(M=M+1, A=M ...), 按指令文本缓存解码和编码结果.
+            返回的记录在多行间共享, 不能修改.
+        """
+        # dest=comp;jump, dest和jump都可省略
+        dest, _, rest = cmd.rpartition("=")
+        comp, _, jump = rest.partition(";")
+        dest, comp, jump = Code.dest(dest), Code.comp(comp), Code.jump(jump)
+        return Instruction(CommandType.C_COMMAND, dest=dest, comp=comp, jump=jump, word=Code.encode(dest, comp, jump))
 
 
 class Code:
+    C_COMMAND_PREFIX = 0b111 << 13
+
     JUMP_TABLE = {
-        "JGT": "001",
-        "JEQ": "010",
-        "JGE": "011",
-        "JLT": "100",
-        "JNE": "101",
-        "JLE": "110",
-        "JMP": "111"
+        "JGT": 0b001,
+        "JEQ": 0b010,
+        "JGE": 0b011,
+        "JLT": 0b100,
+        "JNE": 0b101,
+        "JLE": 0b110,
+        "JMP": 0b111
     }
 
     COMP_TABLE = {
-        '0': '0101010',
-        '1': '0111111',
-        '-1': '0111010',
-        'D': '0001100',
-        'A': '0110000',
-        'M': '1110000',
-        '!D': '0001101',
-        '!A': '0110001',
-        '!M': '1110001',
-        '-D': '0001111',
-        '-A': '0110011',
-        '-M': '1110011',
-        'D+1': '0011111',
-        '1+D': '0011111',
-        'A+1': '0110111',
-        '1+A': '0110111',
-        'M+1': '1110111',
-        '1+M': '1110111',
-        'D-1': '0001110',
-        'A-1': '0110010',
-        'M-1': '1110010',
-        'D+A': '0000010',
-        'A+D': '0000010',
-        'D+M': '1000010',
-        'M+D': '1000010',
-        'D-A': '0010011',
-        'D-M': '1010011',
-        'A-D': '0000111',
-        'M-D': '1000111',
-        'D&A': '0000000',
-        'A&D': '0000000',
-        'D&M': '1000000',
-        'M&D': '1000000',
-        'D|A': '0010101',
-        'A|D': '0010101',
-        'D|M': '1010101',
-        'M|D': '1010101',
+        '0': 0b0101010,
+        '1': 0b0111111,
+        '-1': 0b0111010,
+        'D': 0b0001100,
+        'A': 0b0110000,
+        'M': 0b1110000,
+        '!D': 0b0001101,
+        '!A': 0b0110001,
+        '!M': 0b1110001,
+        '-D': 0b0001111,
+        '-A': 0b0110011,
+        '-M': 0b1110011,
+        'D+1': 0b0011111,
+        '1+D': 0b0011111,
+        'A+1': 0b0110111,
+        '1+A': 0b0110111,
+        'M+1': 0b1110111,
+        '1+M': 0b1110111,
+        'D-1': 0b0001110,
+        'A-1': 0b0110010,
+        'M-1': 0b1110010,
+        'D+A': 0b0000010,
+        'A+D': 0b0000010,
+        'D+M': 0b1000010,
+        'M+D': 0b1000010,
+        'D-A': 0b0010011,
+        'D-M': 0b1010011,
+        'A-D': 0b0000111,
+        'M-D': 0b1000111,
+        'D&A': 0b0000000,
+        'A&D': 0b0000000,
+        'D&M': 0b1000000,
+        'M&D': 0b1000000,
+        'D|A': 0b0010101,
+        'A|D': 0b0010101,
+        'D|M': 0b1010101,
+        'M|D': 0b1010101,
     }
 
     @classmethod
-    def dest(cls, cmd: Optional[str]) -> str:
-        if cmd is None:
-            return '000'
-        d1 = '1' if 'A' in cmd else '0'
-        d2 = '1' if 'D' in cmd else '0'
-        d3 = '1' if 'M' in cmd else '0'
-        return f"{d1}{d2}{d3}"
+    def dest(cls, cmd: Optional[str]) -> int:
+        if not cmd:
+            return 0b000
+        d1 = 0b100 if 'A' in cmd else 0
+        d2 = 0b010 if 'D' in cmd else 0
+        d3 = 0b001 if 'M' in cmd else 0
+        return d1 | d2 | d3
 
     @classmethod
-    def comp(cls, cmd: str) -> str:
+    def comp(cls, cmd: str) -> int:
         # 没发现规律,简单粗暴方案
         return cls.COMP_TABLE[cmd]
 
     @classmethod
-    def jump(cls, cmd: Optional[str]) -> Tuple[str, str, str]:
-        return cls.JUMP_TABLE.get(cmd, "000")
+    def jump(cls, cmd: Optional[str]) -> int:
+        return cls.JUMP_TABLE.get(cmd, 0b000)
+
+    @classmethod
+    def encode(cls, dest: int, comp: int, jump: int) -> int:
+        """ 111a cccc ccdd djjj"""
+        return cls.C_COMMAND_PREFIX | comp << 6 | dest << 3 | jump
+
+
+class RomImage:
+    """ 二进制ROM镜像: 小端16位字紧密排列, 每个字2字节(.hack文本每个字17字节)"""
+
+    @staticmethod
+    def write(rom_file, words: Iterable[int]):
+        image = array('H', words)
+        if sys.byteorder == 'big':
+            image.byteswap()
+        with open(rom_file, "wb") as rom_object:
+            image.tofile(rom_object)
+
+    @staticmethod
+    def load(rom_file) -> memoryview:
+        """ mmap映射镜像文件, 小端机器上零拷贝返回按16位字索引的只读视图"""
+        with open(rom_file, "rb") as rom_object:
+            if not rom_object.seek(0, 2):
+                return memoryview(b"").cast('H')
+            rom_map = mmap.mmap(rom_object.fileno(), 0, access=mmap.ACCESS_READ)
+        if sys.byteorder == 'big':
+            image = array('H', rom_map)
+            image.byteswap()
+            rom_map.close()
+            return memoryview(image)
+        return memoryview(rom_map).cast('H')
+
+
+class PeepholeOptimizer:
+    """
+        汇编级窥孔优化: 在指令流的窗口上匹配模式并替换为更短的等价序列.
+        模式中的 {name} 匹配任意符号/数字并绑定, 同名占位符必须匹配相同的值, 替换序列中按绑定值展开.
+        每条新指令进入窗口时只匹配窗口尾部, 替换后再继续匹配, 因此规则可以级联生效.
+    """
+    RULES: Dict[str, Tuple[Tuple[str, ...], Tuple[str, ...]]] = {
+        # push后立刻pop: SP先加1再减1
+        "push-pop": (("@SP", "M=M+1", "@SP", "M=M-1"), ("@SP",)),
+        # 刚写入内存的值又读回D
+        "store-reload": (("@{a}", "M=D", "@{a}", "D=M"), ("@{a}", "M=D")),
+        "reload": (("M=D", "D=M"), ("M=D",)),
+        # 通过指针写入后又从同一指针读回(假设指针不指向自身, 生成的栈代码总是满足)
+        "pointer-reload": (("@{p}", "A=M", "M=D", "@{p}", "A=M", "D=M"), ("@{p}", "A=M", "M=D")),
+        # neg: 0-D, 后面紧跟A指令所以A寄存器的值不再需要
+        "neg": (("@0", "D=A-D", "@{a}"), ("D=-D", "@{a}")),
+        # 连续两条A指令, 前一条无效
+        "double-load": (("@{a}", "@{b}"), ("@{b}",)),
+        # 跳转到紧跟着的标签
+        "jump-next": (("@{l}", "0;JMP", "({l})", "@{a}"), ("({l})", "@{a}")),
+    }
+
+    def __init__(self, rules: Optional[Iterable[str]] = None):
+        names = list(self.RULES) if rules is None else list(rules)
+        for name in names:
+            if name not in self.RULES:
+                raise Exception(f"unknown peephole rule {name}")
+        self.rules = [(name, self.compile_pattern(self.RULES[name][0]), self.RULES[name][1]) for name in names]
+        self.window = max(len(pattern) for _, pattern, _ in self.rules)
+        # 按模式最后一条指令建索引, 新指令只需检查可能以它结尾的规则
+        self.literal_rules: Dict[str, list] = {}
+        self.placeholder_rules: Dict[str, list] = {}  # 以占位符结尾的规则按指令首字符索引
+        for rule in self.rules:
+            prefix, name, _ = rule[1][-1]
+            if name is None:
+                self.literal_rules.setdefault(prefix, []).append(rule)
+            else:
+                self.placeholder_rules.setdefault(prefix[:1], []).append(rule)
+        self.hits: Dict[str, int] = {name: 0 for name in names}
+        self.saved = 0
+
+    @staticmethod
+    def compile_pattern(pattern: Tuple[str, ...]) -> List[Tuple[str, Optional[str], str]]:
+        """ 每个元素拆成 (前缀, 占位符名, 后缀), 没有占位符时前缀即整条指令"""
+        compiled = []
+        for element in pattern:
+            if match := re.fullmatch(r'(.*)\{(\w+)\}(.*)', element):
+                compiled.append((match.group(1), match.group(2), match.group(3)))
+            else:
+                compiled.append((element, None, ""))
+        return compiled
+
+    @staticmethod
+    def match(pattern: List[Tuple[str, Optional[str], str]], commands: List[str]) -> Optional[Dict[str, str]]:
+        bindings = {}
+        for (prefix, name, suffix), cmd in zip(pattern, commands):
+            if name is None:
+                if cmd != prefix:
+                    return None
+                continue
+            if len(cmd) <= len(prefix) + len(suffix) or not cmd.startswith(prefix) or not cmd.endswith(suffix):
+                return None
+            value = cmd[len(prefix):len(cmd) - len(suffix)]
+            if bindings.setdefault(name, value) != value:
+                return None
+        return bindings
+
+    def rewrite_tail(self, buffer: List[str]):
+        rewritten = True
+        while rewritten and buffer:
+            rewritten = False
+            last = buffer[-1]
+            candidates = chain(self.literal_rules.get(last, ()), self.placeholder_rules.get(last[0], ()))
+            for name, pattern, replacement in candidates:
+                if len(buffer) < len(pattern):
+                    continue
+                bindings = self.match(pattern, buffer[-len(pattern):])
+                if bindings is None:
+                    continue
+                buffer[-len(pattern):] = [element.format(**bindings) for element in replacement]
+                self.hits[name] += 1
+                self.saved += len(pattern) - len(replacement)
+                rewritten = True
+                break
+
+    def optimize(self, commands: Iterable[str]) -> Iterator[str]:
+        buffer: List[str] = []
+        for cmd in commands:
+            buffer.append(cmd)
+            self.rewrite_tail(buffer)
+            # 保留足够长的尾部供后续级联匹配
+            if len(buffer) >= 4 * self.window:
+                yield from buffer[:-self.window]
+                del buffer[:-self.window]
+        yield from buffer
+
+    def report(self) -> str:
+        lines = [f"peephole: {self.saved} instructions removed"]
+        lines += [f"  {name:<16}{hits}" for name, hits in self.hits.items()]
+        return "\n".join(lines)
+
+
+class DeadCodeEliminator:
+    """
+        不可达代码消除: 按标签和跳转把指令切成基本块, 从入口开始沿顺序执行和标签引用做可达性分析, 去掉到不了的块.
+        标签地址只能通过 @label 装入A(再存进内存/寄存器用于 A=M;JMP 之类的间接跳转),
+        所以可达块里引用过的标签就是全部可能的跳转目标.
+        conservative 模式下程序中任何位置引用过的标签都视为可达, 只删除完全没有被引用的代码.
+        遇到目标是数字地址的跳转时无法确定去向, 放弃优化原样输出.
+    """
+
+    def __init__(self, conservative: bool = False):
+        self.conservative = conservative
+        self.removed = 0
+        self.removed_blocks = 0
+        self.aborted: Optional[str] = None
+
+    @staticmethod
+    def split_blocks(commands: List[str]) -> List[List[str]]:
+        """ 标签开始新块(连续的标签属于同一块), 带跳转的指令结束当前块"""
+        blocks: List[List[str]] = []
+        block: List[str] = []
+        for cmd in commands:
+            if cmd[0] == "(" and block and block[-1][0] != "(":
+                blocks.append(block)
+                block = []
+            block.append(cmd)
+            if ";" in cmd:
+                blocks.append(block)
+                block = []
+        if block:
+            blocks.append(block)
+        return blocks
+
+    def optimize(self, commands: Iterable[str]) -> List[str]:
+        commands = list(commands)
+        blocks = self.split_blocks(commands)
+        label_block = {cmd[1:-1]: index for index, block in enumerate(blocks) for cmd in block if cmd[0] == "("}
+
+        roots = {0} if blocks else set()
+        if self.conservative:
+            roots.update(label_block[cmd[1:]] for cmd in commands if cmd[0] == "@" and cmd[1:] in label_block)
+
+        reachable = set(roots)
+        worklist = list(roots)
+        while worklist:
+            index = worklist.pop()
+            successors = []
+            a_value = None  # 块内已知的A寄存器内容(@后面的文本)
+            for cmd in blocks[index]:
+                if cmd[0] == "@":
+                    a_value = cmd[1:]
+                    if a_value in label_block:
+                        successors.append(label_block[a_value])
+                elif cmd[0] != "(":
+                    dest, _, rest = cmd.rpartition("=")
+                    if ";" in rest and a_value is not None and a_value not in label_block:
+                        self.aborted = f"jump to non-label address {a_value}"
+                        return commands
+                    if "A" in dest:
+                        a_value = None
+            last = blocks[index][-1]
+            if not last.endswith(";JMP") and index + 1 < len(blocks):
+                successors.append(index + 1)
+            for successor in successors:
+                if successor not in reachable:
+                    reachable.add(successor)
+                    worklist.append(successor)
+
+        output = []
+        for index, block in enumerate(blocks):
+            if index in reachable:
+                output.extend(block)
+            else:
+                self.removed_blocks += 1
+                self.removed += sum(1 for cmd in block if cmd[0] != "(")
+        return output
+
+    def report(self) -> str:
+        if self.aborted:
+            return f"dce: skipped, {self.aborted}"
+        return f"dce: {self.removed} instructions removed in {self.removed_blocks} blocks"
+
+
+class ParallelEncoder:
+    """
+        多进程编码: 符号表在主进程完成后通过进程池的 initializer 发给每个工作进程一次,
+        各进程独立解码/编码一段指令并格式化为.hack文本, 主进程按顺序拼接.
+    """
+    symbols: Dict[str, int] = {}
+
+    @staticmethod
+    def init_worker(symbols: Dict[str, int]):
+        ParallelEncoder.symbols = symbols
+
+    @staticmethod
+    def encode_chunk(commands: List[str]) -> Tuple[str, bytes]:
+        """ 返回 (.hack文本, 机器码的array('I')字节), 超出ROM的程序里标签地址可能大于16位"""
+        symbols = ParallelEncoder.symbols
+        words = array('I')
+        for cmd in commands:
+            instruction = Parser.decode(cmd)
+            words.append(instruction.word if instruction.symbol is None else symbols[instruction.symbol])
+        return "".join(f"{word:0>16b}\n" for word in words), words.tobytes()
+
+    @classmethod
+    def encode(cls, commands: List[str], symbols: Dict[str, int], jobs: int) -> Tuple[str, List[int]]:
+        chunk_size = -(-len(commands) // (jobs * 4))  # 每个进程分几块, 平衡各块耗时的差异
+        chunks = [commands[start:start + chunk_size] for start in range(0, len(commands), chunk_size)]
+        hack_text, words = [], array('I')
+        with ProcessPoolExecutor(max_workers=jobs, initializer=cls.init_worker, initargs=(symbols,)) as executor:
+            for text, word_bytes in executor.map(cls.encode_chunk, chunks):
+                hack_text.append(text)
+                words.frombytes(word_bytes)
+        return "".join(hack_text), words.tolist()
+
+
+class SourceMap:
+    """
+        ROM地址 -> asm行号 -> vm命令 的映射, 条目按地址递增, 查找某地址时二分找到不大于它的最后一条.
+        文件格式(小端): b"HMAP", 条目数u32, 字符串数u32,
+        条目 (地址u32, asm行号u32, vm命令下标i32, -1表示没有) * 条目数, 字符串 (长度u16, utf-8) * 字符串数
+    """
+    MAGIC = b"HMAP"
+    HEADER = struct.Struct("<4sII")
+    ENTRY = struct.Struct("<IIi")
+    STRING_LENGTH = struct.Struct("<H")
+
+    def __init__(self):
+        self.entries: List[Tuple[int, int, int]] = []
+        self.strings: List[str] = []
+        self.string_index: Dict[str, int] = {}
+
+    def add(self, address: int, line: int, vm_command: Optional[str]):
+        if vm_command is None:
+            index = -1
+        elif (index := self.string_index.get(vm_command)) is None:
+            index = self.string_index[vm_command] = len(self.strings)
+            self.strings.append(vm_command)
+        if self.entries and self.entries[-1][0] == address:
+            self.entries[-1] = (address, line, index)
+        else:
+            self.entries.append((address, line, index))
+
+    def lookup(self, address: int) -> Optional[Tuple[int, Optional[str]]]:
+        """ 返回 (asm行号, vm命令)"""
+        position = bisect_right(self.entries, (address, 0xFFFFFFFF, 0x7FFFFFFF)) - 1
+        if position < 0:
+            return None
+        _, line, index = self.entries[position]
+        return line, self.strings[index] if index >= 0 else None
+
+    def write(self, map_file):
+        with open(map_file, "wb") as map_object:
+            map_object.write(self.HEADER.pack(self.MAGIC, len(self.entries), len(self.strings)))
+            map_object.write(b"".join(self.ENTRY.pack(*entry) for entry in self.entries))
+            for string in self.strings:
+                encoded = string.encode()
+                map_object.write(self.STRING_LENGTH.pack(len(encoded)) + encoded)
+
+    @classmethod
+    def load(cls, map_file) -> "SourceMap":
+        with open(map_file, "rb") as map_object:
+            data = map_object.read()
+        magic, entry_count, string_count = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC:
+            raise Exception(f"{map_file} is not a source map")
+        source_map = cls()
+        offset = cls.HEADER.size
+        source_map.entries = [entry for entry in cls.ENTRY.iter_unpack(data[offset:offset + entry_count * cls.ENTRY.size])]
+        offset += entry_count * cls.ENTRY.size
+        for _ in range(string_count):
+            length, = cls.STRING_LENGTH.unpack_from(data, offset)
+            offset += cls.STRING_LENGTH.size
+            source_map.strings.append(data[offset:offset + length].decode())
+            offset += length
+        source_map.string_index = {string: index for index, string in enumerate(source_map.strings)}
+        return source_map
+
+
+class SizeReport:
+    """ 按函数统计ROM占用: 每个 Class.method 标签开始一个区域, 其它标签(循环/返回地址等)并入所在区域"""
+    ENTRY_REGION = "<entry>"
+
+    def __init__(self, labels: Dict[str, int], total: int):
+        self.total = total
+        self.overflow = total - ROM_SIZE
+        self.regions: List[Tuple[str, int, int]] = []  # (区域名, 起始地址, 指令数)
+
+        owner, start = self.ENTRY_REGION, 0
+        for label, address in sorted(labels.items(), key=lambda item: item[1]):
+            if FUNCTION_LABEL_PATTERN.fullmatch(label):
+                self.add_region(owner, start, address)
+                owner, start = label, address
+        self.add_region(owner, start, total)
+        self.regions.sort(key=lambda region: region[2], reverse=True)
+
+    def add_region(self, name: str, start: int, end: int):
+        if name == self.ENTRY_REGION and start == end:
+            return
+        self.regions.append((name, start, end - start))
+
+    def to_text(self) -> str:
+        lines = [f"ROM usage: {self.total} / {ROM_SIZE} words ({self.total / ROM_SIZE:.1%})"]
+        if self.overflow > 0:
+            lines.append(f"Program too large: {self.overflow} words over the ROM limit")
+        lines.append(f"{'size':>8} {'%':>7} {'address':>8}  region")
+        for name, start, size in self.regions:
+            lines.append(f"{size:>8} {size / max(self.total, 1):>7.2%} {start:>8}  {name}")
+        return "\n".join(lines) + "\n"
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "total": self.total,
+            "rom_size": ROM_SIZE,
+            "overflow": max(self.overflow, 0),
+            "regions": [{"name": name, "address": start, "size": size} for name, start, size in self.regions],
+        }, indent=2)
+
+    def write(self, text_file, json_file):
+        with open(text_file, "w") as text_object:
+            text_object.write(self.to_text())
+        with open(json_file, "w") as json_object:
+            json_object.write(self.to_json())
 
 
 class Assembler:
 
-    def __init__(self, asm_file):
+    def __init__(self, asm_file, single_pass=True, write_bin=False, peephole: Optional[PeepholeOptimizer] = None,
+                 write_report=False, dead_code_eliminator: Optional[DeadCodeEliminator] = None, write_symbols=False,
+                 jobs=1, parallel_min_instructions=PARALLEL_MIN_INSTRUCTIONS):
         self.asm_file = asm_file
         self.hack_file = Path(asm_file).with_suffix(".hack")
+        self.bin_file = Path(asm_file).with_suffix(".bin")
+        self.write_bin = write_bin
+        self.write_report = write_report
+        self.write_symbols = write_symbols
+        self.source_map = SourceMap() if write_symbols else None
         self.symbol_table = SymbolTable()
         self.parser = None
+        self.single_pass = single_pass
+        self.jobs = jobs or os.cpu_count() or 1
+        self.parallel_min_instructions = parallel_min_instructions
+        self.peephole = peephole
+        self.dead_code_eliminator = dead_code_eliminator
+        self.instructions: List[Instruction] = []
+        self.labels: Dict[str, int] = {}  # 标签 -> ROM地址, 按定义顺序
+
+    def iter_commands(self, asm_lines: Iterable[str]) -> Iterator[str]:
+        """ 去掉注释和空行后的指令文本, 再依次经过开启的窥孔优化和不可达代码消除"""
+        self.parser = Parser(iter(asm_lines), track_source=self.write_symbols)
+        commands = self.parser.commands()
+        if self.peephole:
+            commands = self.peephole.optimize(commands)
+        if self.dead_code_eliminator:
+            commands = iter(self.dead_code_eliminator.optimize(commands))
+        return commands
 
     def first_assemble(self):
         """ 遍历发现符号，并赋予地址"""
         asm_object = open(self.asm_file)
-        self.parser = Parser(asm_object)
         pc_count = 0
 
         value_table = OrderedDict()
 
-        while self.parser.has_more_commands():
-            self.parser.advance()
-            command_type = self.parser.command_type
-            if command_type == CommandType.A_COMMAND:
-                if symbol := SYMBOL_PATTERN.match(self.parser.symbol):
-                    if symbol.string not in value_table and not self.symbol_table.contains(symbol.string):
-                        value_table[symbol.string] = 1
-            elif command_type == CommandType.L_COMMAND:
-                self.symbol_table.add_entry(self.parser.symbol, pc_count)
-                value_table.pop(self.parser.symbol, None)
+        for cmd in self.iter_commands(asm_object):
+            instruction = Parser.decode(cmd)
+            if instruction.command_type == CommandType.A_COMMAND:
+                symbol = instruction.symbol
+                if symbol is not None and symbol not in value_table and not self.symbol_table.contains(symbol):
+                    value_table[symbol] = 1
+            elif instruction.command_type == CommandType.L_COMMAND:
+                self.symbol_table.add_entry(instruction.symbol, pc_count)
+                self.labels[instruction.symbol] = pc_count
+                value_table.pop(instruction.symbol, None)
                 continue
+            self.instructions.append(instruction)
+            self.record_source(pc_count, cmd)
             pc_count += 1
 
         address_count = 16
@@ -213,33 +635,161 @@ class Assembler:
         asm_object.close()
 
     def second_assemble(self):
-        asm_object = open(self.asm_file)
-        self.parser = Parser(asm_object)
-        hack_object = open(self.hack_file, "w")
-
-        while self.parser.has_more_commands():
-            self.parser.advance()
-            command_type = self.parser.command_type
-            if command_type == CommandType.A_COMMAND:
-                if symbol := SYMBOL_PATTERN.match(self.parser.symbol):
-                    address = self.symbol_table.get_address(symbol.string)
-                else:
-                    address = int(self.parser.symbol)
-                print(f"0{address:0>15b}", file=hack_object)
-
-            elif command_type == CommandType.C_COMMAND:
-                dest = Code.dest(self.parser.dest)
-                comp = Code.comp(self.parser.comp)
-                jump = Code.jump(self.parser.jump)
-                print(f"111{comp}{dest}{jump}", file=hack_object)
+        """ 直接使用第一遍解码好的指令记录, 不再重新读取和解析源文件"""
+        words = []
+        for instruction in self.instructions:
+            if instruction.symbol is not None:
+                words.append(self.symbol_table.get_address(instruction.symbol))
+            else:
+                words.append(instruction.word)
+        self.write_output(words)
+
+    def assemble_lines(self, asm_lines: Iterable[str]) -> List[int]:
+        """
+            单遍汇编: 接受任意asm行的迭代器, 每行只解析一次.
+            带符号的指令先只记下符号, 读完全部输入后统一回填: 重复定义的标签与两遍汇编一样以最后一次定义为准,
+            到最后仍未定义为标签的符号按首次出现顺序分配变量地址.
+        """
+        words: List[Union[int, str]] = []
+
+        for cmd in self.iter_commands(asm_lines):
+            instruction = Parser.decode(cmd)
+            if instruction.command_type == CommandType.L_COMMAND:
+                self.symbol_table.add_entry(instruction.symbol, len(words))
+                self.labels[instruction.symbol] = len(words)
+                continue
 
-        asm_object.close()
-        hack_object.close()
+            self.record_source(len(words), cmd)
+            words.append(instruction.word if instruction.symbol is None else instruction.symbol)
+
+        address_count = 16
+        for index, word in enumerate(words):
+            if isinstance(word, str):
+                if not self.symbol_table.contains(word):
+                    self.symbol_table.add_entry(word, address_count)
+                    address_count += 1
+                words[index] = self.symbol_table.get_address(word)
+        return words
+
+    def parallel_assemble(self):
+        """
+            多进程两遍汇编: 第一遍只在主进程扫描标签和变量, 不解码指令;
+            符号表完成后把指令文本分块交给进程池编码, 程序较小时直接在本进程编码.
+        """
+        commands: List[str] = []
+        value_table = OrderedDict()
+        with open(self.asm_file) as asm_object:
+            for cmd in self.iter_commands(asm_object):
+                if cmd[0] == "(":
+                    label = cmd[1:-1]
+                    self.symbol_table.add_entry(label, len(commands))
+                    self.labels[label] = len(commands)
+                    value_table.pop(label, None)
+                    continue
+                if cmd[0] == "@":
+                    symbol = cmd[1:]
+                    if SYMBOL_PATTERN.match(symbol) and symbol not in value_table and not self.symbol_table.contains(symbol):
+                        value_table[symbol] = 1
+                self.record_source(len(commands), cmd)
+                commands.append(str(cmd))
+
+        address_count = 16
+        for key in value_table:
+            self.symbol_table.add_entry(key, address_count)
+            address_count += 1
+
+        if self.jobs > 1 and len(commands) >= self.parallel_min_instructions:
+            hack_text, words = ParallelEncoder.encode(commands, self.symbol_table.table, self.jobs)
+            self.write_output(words, hack_text)
+        else:
+            ParallelEncoder.init_worker(self.symbol_table.table)
+            hack_text, word_bytes = ParallelEncoder.encode_chunk(commands)
+            self.write_output(array('I', word_bytes).tolist(), hack_text)
+
+    def record_source(self, address: int, cmd: str):
+        if self.source_map is not None and isinstance(cmd, SourceLine):
+            self.source_map.add(address, cmd.line, cmd.vm_command)
+
+    def single_pass_assemble(self):
+        with open(self.asm_file) as asm_object:
+            words = self.assemble_lines(asm_object)
+        self.write_output(words)
+
+    def assemble_stream(self, asm_lines: Iterable[str]):
+        """ 直接汇编内存中的asm行(例如Vmtranslator的输出), 不需要中间的.asm文件"""
+        self.write_output(self.assemble_lines(asm_lines))
+
+    def write_output(self, words: List[int], hack_text: Optional[str] = None):
+        """ hack_text 为已经格式化好的.hack内容(并行编码时由工作进程生成)"""
+        if hack_text is None:
+            self.write_hack(words)
+        else:
+            with open(self.hack_file, "w") as hack_object:
+                hack_object.write(hack_text)
+        if self.write_bin:
+            RomImage.write(self.bin_file, words)
+
+        report = SizeReport(self.labels, len(words))
+        if self.write_report:
+            report.write(self.hack_file.with_suffix(".size.txt"), self.hack_file.with_suffix(".size.json"))
+        if self.write_symbols:
+            self.write_sym()
+            self.source_map.write(self.hack_file.with_suffix(".map"))
+        if report.overflow > 0:
+            print(f"Program too large: {report.total} words, {report.overflow} over the {ROM_SIZE} word ROM"
+                  f"{'' if self.write_report else ' (use --report to see which functions are responsible)'}",
+                  file=sys.stderr)
+
+    def write_sym(self):
+        """ 每行 "ROM|RAM 地址 符号": 标签按定义顺序, 变量按分配顺序, 不含预定义符号"""
+        predefined = SymbolTable().table
+        lines = [f"ROM {address} {label}\n" for label, address in self.labels.items()]
+        lines += [f"RAM {address} {symbol}\n" for symbol, address in self.symbol_table.table.items()
+                  if symbol not in predefined and symbol not in self.labels]
+        with open(self.hack_file.with_suffix(".sym"), "w") as sym_object:
+            sym_object.write("".join(lines))
+
+    def write_hack(self, words: List[int]):
+        """ 只在输出时才把机器码格式化为文本"""
+        with open(self.hack_file, "w") as hack_object:
+            hack_object.write("".join(f"{word:0>16b}\n" for word in words))
 
     def assemble(self):
-        self.first_assemble()
-        self.second_assemble()
+        if self.jobs > 1:
+            self.parallel_assemble()
+        elif self.single_pass:
+            self.single_pass_assemble()
+        else:
+            self.first_assemble()
+            self.second_assemble()
 
 
 if __name__ == '__main__':
-    Assembler(sys.argv[1]).assemble()
+    parser = argparse.ArgumentParser(description="Assembler")
+    parser.add_argument("asm_file", type=str, help="asm file path")
+    parser.add_argument('--two-pass', help="use the classic two pass assembler", action="store_true")
+    parser.add_argument('--bin', '-b', help="also write a little-endian 16-bit ROM image (.bin)", action="store_true")
+    parser.add_argument('--peephole', '-p', help="run the peephole optimizer before encoding", action="store_true")
+    parser.add_argument('--peephole-rules', type=str, help=f"comma separated peephole rules, default all: {','.join(PeepholeOptimizer.RULES)}")
+    parser.add_argument('--report', '-r', help="write ROM size per function region (.size.txt/.size.json)", action="store_true")
+    parser.add_argument('--dce', help="drop code that no jump or label reference can reach", action="store_true")
+    parser.add_argument('--dce-conservative', help="like --dce, but every label referenced anywhere stays reachable", action="store_true")
+    parser.add_argument('--symbols', '-s', help="write the symbol table (.sym) and a ROM address source map (.map)", action="store_true")
+    parser.add_argument('--jobs', '-j', type=int, default=1, help="encode in N processes, 0 = all cores; "
+                        "always uses the two pass assembler, like --two-pass")
+    parser.add_argument('--parallel-min', type=int, default=PARALLEL_MIN_INSTRUCTIONS,
+                        help=f"with --jobs, encode in one process below this many instructions (default {PARALLEL_MIN_INSTRUCTIONS})")
+    args = parser.parse_args()
+    peephole_optimizer = None
+    if args.peephole or args.peephole_rules:
+        peephole_optimizer = PeepholeOptimizer(args.peephole_rules.split(",") if args.peephole_rules else None)
+    dead_code_eliminator = None
+    if args.dce or args.dce_conservative:
+        dead_code_eliminator = DeadCodeEliminator(conservative=args.dce_conservative)
+    Assembler(args.asm_file, single_pass=not args.two_pass, write_bin=args.bin, peephole=peephole_optimizer,
+              write_report=args.report, dead_code_eliminator=dead_code_eliminator, write_symbols=args.symbols,
+              jobs=args.jobs, parallel_min_instructions=args.parallel_min).assemble()
+    if peephole_optimizer:
+        print(peephole_optimizer.report())
+    if dead_code_eliminator:
+        print(dead_code_eliminator.report())
@@ -6,16 +6,23 @@ class BaseParser:
     def __init__(self, parse_object: TextIO):
         self.parse_object = parse_object
         self.current_line = None
+        self.line_number = 0  # current_line 在源文件中的行号(从1开始)
+
+    def read_comment(self, comment: str):
+        """ 整行注释的回调, 默认忽略, 子类需要注释内容时覆盖"""
+        pass
 
     def has_more_commands(self) -> bool:
         try:
             while True:
                 current_line = next(self.parse_object)
+                self.line_number += 1
                 current_line = current_line.strip()
                 if not current_line:
                     continue
                 if (index := current_line.find("//")) >= 0:
                     if index == 0:
+                        self.read_comment(current_line)
                         continue
                     else:
                         current_line = current_line.split("//")[0].strip()
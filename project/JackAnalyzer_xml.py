@@ -1,208 +1,13 @@
 import argparse
 import functools
-from enum import IntEnum
 from pathlib import Path
-from typing import TextIO, List, Dict
+from typing import List, Tuple
 from xml.etree.ElementTree import SubElement, ElementTree, Element, indent
 
-
-class TokenType(IntEnum):
-    KEYWORD = 1
-    SYMBOL = 2
-    IDENTIFIER = 3
-    INT_CONST = 4
-    STRING_CONST = 5
-
-
-class KeywordType(IntEnum):
-    CLASS = 1
-    METHOD = 2
-    INT = 3
-    FUNCTION = 4
-    BOOLEAN = 5
-    CONSTRUCTOR = 6
-    CHAR = 7
-    VOID = 8
-    VAR = 9
-    STATIC = 10
-    FIELD = 11
-    LET = 12
-    DO = 13
-    IF = 14
-    ELSE = 15
-    WHILE = 16
-    RETURN = 17
-    TRUE = 18
-    FALSE = 19
-    NULL = 20
-    THIS = 21
-
-
-Str2KeywordType: Dict[str, KeywordType] = {
-    "class": KeywordType.CLASS,
-    "constructor": KeywordType.CONSTRUCTOR,
-    "function": KeywordType.FUNCTION,
-    "method": KeywordType.METHOD,
-    "field": KeywordType.FIELD,
-    "static": KeywordType.STATIC,
-    "var": KeywordType.VAR,
-    "int": KeywordType.INT,
-    "char": KeywordType.CHAR,
-    "boolean": KeywordType.BOOLEAN,
-    "void": KeywordType.VOID,
-    "true": KeywordType.TRUE,
-    "false": KeywordType.FALSE,
-    "null": KeywordType.NULL,
-    "this": KeywordType.THIS,
-    "let": KeywordType.LET,
-    "do": KeywordType.DO,
-    "if": KeywordType.IF,
-    "else": KeywordType.ELSE,
-    "while": KeywordType.WHILE,
-    "return": KeywordType.RETURN
-}
-
-KeywordType2Str: Dict[KeywordType, str] = {value: key for key, value in Str2KeywordType.items()}
-KeyWords = set(Str2KeywordType.keys())
-
-Symbols = set("{}()[].,;+-*/&|<>=~")
-OpSymbols = set("+-*/&|<>=")
-UnaryOpSymbols = set('-~')
-
-
-class JackTokenizer:
-
-    def __init__(self, parse_object: TextIO):
-        self.parse_object = parse_object
-        self.buffer = []
-        self.preview_char = None
-
-        self.token = ""
-        self._token_type = None
-        self._token_value = None
-
-        self._next_token_value = None
-        self._next_token_type = None
-
-        # 先取一个符号
-        self.has_more_commands()
-        self.gen_token_info()
-
-    def gen_token_info(self):
-        self.token = "".join(self.buffer)
-        self.buffer = []
-        self.gen_token_type_and_value()
-
-    def ignore_comments(self, char):
-        if char == '/':   # // 类注释 到行尾
-            while self.parse_object.read(1) != '\n':
-                pass
-        elif char == '*':  # /* 类注释 到 */
-            preview = ''
-            while char := self.parse_object.read(1):
-                if preview == '*' and char == '/':
-                    break
-                else:
-                    preview = char
-
-    def has_more_commands(self) -> True:
-        if self.preview_char in Symbols:
-            self.buffer.append(self.preview_char)
-            self.preview_char = None
-            return True
-
-        while char := self.preview_char or self.parse_object.read(1):  # 这样可支持流式输入
-            self.preview_char = None
-            if char == '/':
-                next_char = self.parse_object.read(1)
-                if next_char in "*/":
-                    self.ignore_comments(next_char)
-                else:
-                    self.buffer.append(char)
-                    if next_char != " ":
-                        self.preview_char = next_char
-                    break
-            elif char in Symbols:
-                # 比较丑陋的实现
-                if not self.buffer:
-                    self.buffer.append(char)
-                else:
-                    self.preview_char = char
-                break
-            elif char == '"':
-                self.buffer.append(char)
-                while (char := self.parse_object.read(1)) != '"':
-                    self.buffer.append(char)
-                self.buffer.append(char)
-                break
-            elif char not in ('\n', '\t', '', ' '):
-                self.buffer.append(char)
-            else:
-                if self.buffer:
-                    break
-        return len(self.buffer) > 0
-
-    def gen_token_type_and_value(self):
-        if self.token in KeyWords:
-            self._next_token_type = TokenType.KEYWORD
-            self._next_token_value = Str2KeywordType[self.token]
-        elif self.token in Symbols:
-            self._next_token_type = TokenType.SYMBOL
-            self._next_token_value = self.token
-        elif self.token.isnumeric():
-            self._next_token_type = TokenType.INT_CONST
-            self._next_token_value = int(self.token)
-        elif self.token.startswith('"'):
-            self._next_token_type = TokenType.STRING_CONST
-            self._next_token_value = self.token[1:-1]
-        else:
-            self._next_token_type = TokenType.IDENTIFIER
-            self._next_token_value = self.token
-
-    def advance(self):
-        self._token_type = self._next_token_type
-        self._token_value = self._next_token_value
-
-        # 提前获取下一个token
-        self.has_more_commands()
-        self.gen_token_info()
-        return self.token
-
-    @property
-    def next_token_type(self) -> TokenType:
-        return self._next_token_type
-
-    @property
-    def next_token_value(self):
-        return self._next_token_value
-
-    @property
-    def token_type(self) -> TokenType:
-        return self._token_type
-
-    @property
-    def token_value(self):
-        return self._token_value
-
-    @property
-    def keyword(self) -> KeywordType:
-        return self._token_value
-
-    @property
-    def symbol(self) -> str:
-        return self._token_value
-
-    @property
-    def identifier(self) -> str:
-        return self._token_value
-
-    @property
-    def int_value(self) -> int:
-        return self._token_value
-
-    @property
-    def string_value(self) -> str:
-        return self._token_value
+from JackAst import (JackParser, JackType, ClassDec, SubroutineDec, VarDec, Statement, LetStatement, IfStatement,
+                     WhileStatement, DoStatement, ReturnStatement, Expression, BinaryOp, UnaryOp, ParenExpression,
+                     VarTerm, ArrayTerm, SubroutineCall, KeywordConstant, IntegerConstant, StringConstant)
+from JackTokenizer import JackTokenizer, KeywordType, KeywordType2Str
 
 
 def sub_element(sub_name):
@@ -220,86 +25,39 @@ def sub_element(sub_name):
 
 
 class CompilationEngine:
-    def __init__(self, tokenizer: JackTokenizer, file_name):
-        self.tokenizer = tokenizer
+    """
+        遍历一个类的语法树, 按原来的token顺序生成xml.
+    """
+    def __init__(self, class_dec: ClassDec, file_name):
+        self.class_dec = class_dec
         self.current_root = None
         self.root = None
         self.file_name = file_name
-        self.class_name = None
         self.indent = 0
 
-    def advance_and_check_token(self, token_type: TokenType, token_value=None, token_values=None):
-        self.tokenizer.advance()
-        if token_type != self.tokenizer.token_type:
-            raise Exception(f"expect token_type[{token_type}] get token_type[{self.tokenizer.token_type}]")
-        if token_value is not None and self.tokenizer.token_value != token_value:
-            raise Exception(f"expect token_value[{token_value}] get token_value[{self.tokenizer.token_value}]")
-        if token_values is not None and self.tokenizer.token_value not in token_values:
-            raise Exception(f"expect token_values in [{token_values}] get token_value[{self.tokenizer.token_value}]")
-
-    def check_token(self, token_type: TokenType, token_value=None, token_values=None) -> bool:
-        if token_type != self.tokenizer.token_type:
-            return False
-        if token_value is not None and self.tokenizer.token_value != token_value:
-            return False
-        if token_values is not None and self.tokenizer.token_value not in token_values:
-            return False
-        return True
-
-    def check_next_token(self, token_type: TokenType, token_value=None, token_values=None) -> bool:
-        if token_type != self.tokenizer.next_token_type:
-            return False
-        if token_value is not None and self.tokenizer.next_token_value != token_value:
-            return False
-        if token_values is not None and self.tokenizer.next_token_value not in token_values:
-            return False
-        return True
-
-    def gen_keyword_content(self):
-        SubElement(self.current_root, "keyword").text = f" {KeywordType2Str[self.tokenizer.token_value]} "
-
-    def gen_identifier_content(self):
-        SubElement(self.current_root, "identifier").text = f" {self.tokenizer.token_value} "
-
-    def gen_symbol_content(self):
-        SubElement(self.current_root, "symbol").text = f" {self.tokenizer.token_value} "
-
-    def gen_integer_constant_content(self):
-        SubElement(self.current_root, "integerConstant").text = f" {self.tokenizer.token_value} "
-
-    def gen_string_constant_content(self):
-        SubElement(self.current_root, "stringConstant").text = f" {self.tokenizer.token_value} "
-
-    def check_next_symbol(self, symbol_value=None, symbol_values=None) -> bool:
-        return self.check_next_token(TokenType.SYMBOL, symbol_value, symbol_values)
-
-    def check_symbol(self, symbol_value=None, symbol_values=None) -> bool:
-        return self.check_token(TokenType.SYMBOL, symbol_value, symbol_values)
-
-    def compile_symbol(self, symbol_value=None, symbol_values=None):
-        self.advance_and_check_token(TokenType.SYMBOL, symbol_value, symbol_values)
-        self.gen_symbol_content()
-
-    def compile_identifier(self):
-        self.advance_and_check_token(TokenType.IDENTIFIER)
-        self.gen_identifier_content()
-
-    def compile_var_name(self):
-        self.compile_identifier()
-
-    def compile_classname(self):
-        self.compile_identifier()
-        self.class_name = self.tokenizer.token_value
-
-    def compile_keyword(self, keyword=None, keywords=None):
-        self.advance_and_check_token(TokenType.KEYWORD, keyword, keywords)
-        self.gen_keyword_content()
+    def gen_keyword_content(self, keyword: KeywordType):
+        SubElement(self.current_root, "keyword").text = f" {KeywordType2Str[keyword]} "
+
+    def gen_identifier_content(self, identifier: str):
+        SubElement(self.current_root, "identifier").text = f" {identifier} "
+
+    def gen_symbol_content(self, symbol: str):
+        SubElement(self.current_root, "symbol").text = f" {symbol} "
+
+    def gen_integer_constant_content(self, value: int):
+        SubElement(self.current_root, "integerConstant").text = f" {value} "
+
+    def gen_string_constant_content(self, value: str):
+        SubElement(self.current_root, "stringConstant").text = f" {value} "
+
+    def gen_type_content(self, jack_type: JackType):
+        if isinstance(jack_type, KeywordType):
+            self.gen_keyword_content(jack_type)
+        else:
+            self.gen_identifier_content(jack_type)
 
     def compile(self):
-        try:
-            self.compile_class()
-        except Exception as error:
-            print(f"************** {error}")
+        self.compile_class()
         xml_tree = ElementTree(self.root)
         indent(xml_tree)
         xml_tree.write(f'{self.file_name}.xml', encoding='utf-8', short_empty_elements=False)
@@ -310,281 +68,224 @@ class CompilationEngine:
         """
         self.root = self.current_root = Element("class")
 
-        self.compile_keyword(KeywordType.CLASS)
-        self.compile_classname()
-        self.compile_symbol('{')
+        self.gen_keyword_content(KeywordType.CLASS)
+        self.gen_identifier_content(self.class_dec.name)
+        self.gen_symbol_content('{')
 
         # classVarDec*
-        while self.check_next_token(TokenType.KEYWORD, token_values={KeywordType.STATIC, KeywordType.FIELD}):
-            self.compile_class_var_dec()
+        for var_dec in self.class_dec.var_decs:
+            self.compile_class_var_dec(var_dec)
 
         # subroutineDec*
-        while self.check_next_token(TokenType.KEYWORD, token_values={KeywordType.CONSTRUCTOR, KeywordType.FUNCTION, KeywordType.METHOD}):
-            self.compile_subroutine()
+        for subroutine in self.class_dec.subroutines:
+            self.compile_subroutine(subroutine)
 
-        self.compile_symbol('}')
+        self.gen_symbol_content('}')
 
-    @sub_element("classVarDec")
-    def compile_class_var_dec(self):
+    def compile_var_names(self, var_dec: VarDec):
         """
-            ('static'|'filed') type varName (',' varName)* ';'
+            ('static'|'filed'|'var') type varName (',' varName)* ';'
         """
-        # ('static'|'filed')
-        self.advance_and_check_token(TokenType.KEYWORD, token_values={KeywordType.STATIC, KeywordType.FIELD})
-        self.gen_keyword_content()
-
-        self.compile_type()
-        self.compile_var_name()
-
-        while self.check_next_symbol(","):
-            self.compile_symbol(",")
-            self.compile_var_name()
+        self.gen_keyword_content(var_dec.kind)
+        self.gen_type_content(var_dec.type)
+        for index, var_name in enumerate(var_dec.names):
+            if index:
+                self.gen_symbol_content(",")
+            self.gen_identifier_content(var_name)
+        self.gen_symbol_content(";")
 
-        self.compile_symbol(";")
+    @sub_element("classVarDec")
+    def compile_class_var_dec(self, var_dec: VarDec):
+        self.compile_var_names(var_dec)
 
     @sub_element("subroutineDec")
-    def compile_subroutine(self):
+    def compile_subroutine(self, subroutine: SubroutineDec):
         """
             ('constructor' | 'function' | 'method') ('void'|type) subroutineName '(' parameterList ')' subroutineBody
         """
-        # ('constructor' | 'function' | 'method')
-        self.advance_and_check_token(TokenType.KEYWORD, token_values={KeywordType.CONSTRUCTOR, KeywordType.FUNCTION, KeywordType.METHOD})
-        self.gen_keyword_content()
-
-        # ('void'|type)
-        self.compile_type()
-
-        # subroutineName
-        self.compile_identifier()
+        self.gen_keyword_content(subroutine.kind)
+        self.gen_type_content(subroutine.return_type)
+        self.gen_identifier_content(subroutine.name)
 
-        self.compile_symbol('(')
-        self.compile_parameter_list()
-        self.compile_symbol(')')
+        self.gen_symbol_content('(')
+        self.compile_parameter_list(subroutine.parameters)
+        self.gen_symbol_content(')')
 
-        self.compile_subroutine_body()
-
-    def compile_type(self):
-        self.tokenizer.advance()
-        if self.check_token(TokenType.KEYWORD, token_values={KeywordType.VOID, KeywordType.INT, KeywordType.CHAR, KeywordType.BOOLEAN}):
-            self.gen_keyword_content()
-        elif self.check_token(TokenType.IDENTIFIER):
-            self.gen_identifier_content()
+        self.compile_subroutine_body(subroutine)
 
     @sub_element("parameterList")
-    def compile_parameter_list(self, finish_char=')'):
+    def compile_parameter_list(self, parameters: List[Tuple[JackType, str]]):
         """
             (type varName)(',' type varName)*
         """
-        if self.check_next_symbol(finish_char):
+        if not parameters:
             self.current_root.text = f"\n{self.indent*'  '}"
             return
 
-        self.compile_type()
-        self.compile_var_name()
-
-        # ',' type varName)*
-        while self.check_next_symbol(','):
-            self.compile_symbol(',')
-            self.compile_type()
-            self.compile_var_name()
+        for index, (param_type, param_name) in enumerate(parameters):
+            if index:
+                self.gen_symbol_content(',')
+            self.gen_type_content(param_type)
+            self.gen_identifier_content(param_name)
 
     @sub_element("subroutineBody")
-    def compile_subroutine_body(self):
+    def compile_subroutine_body(self, subroutine: SubroutineDec):
         """
             '{‘ varDec* statement '}'
         """
-        self.compile_symbol('{')
+        self.gen_symbol_content('{')
 
         # varDec*
-        while self.check_next_token(TokenType.KEYWORD, KeywordType.VAR):
-            self.compile_var_dec()
-        self.compile_statements()
-        self.compile_symbol('}')
+        for var_dec in subroutine.var_decs:
+            self.compile_var_dec(var_dec)
+        self.compile_statements(subroutine.statements)
+        self.gen_symbol_content('}')
 
     @sub_element("varDec")
-    def compile_var_dec(self):
-        """
-            ’var‘ type varName (',' varName)* ';'
-        """
-        # var
-        self.advance_and_check_token(TokenType.KEYWORD, token_value=KeywordType.VAR)
-        self.gen_keyword_content()
-
-        self.compile_type()
-        self.compile_var_name()
-
-        while self.check_next_symbol(","):
-            self.compile_symbol(",")
-            self.compile_var_name()
-
-        self.compile_symbol(";")
+    def compile_var_dec(self, var_dec: VarDec):
+        self.compile_var_names(var_dec)
 
     @sub_element("statements")
-    def compile_statements(self):
-
-        while self.check_next_token(TokenType.KEYWORD, token_values={
-            KeywordType.LET, KeywordType.IF, KeywordType.WHILE, KeywordType.DO, KeywordType.RETURN
-        }):
-            if self.check_next_token(TokenType.KEYWORD, token_value=KeywordType.LET):
-                self.compile_let()
-            elif self.check_next_token(TokenType.KEYWORD, token_value=KeywordType.DO):
-                self.compile_do()
-            elif self.check_next_token(TokenType.KEYWORD, token_value=KeywordType.RETURN):
-                self.compile_return()
-            elif self.check_next_token(TokenType.KEYWORD, token_value=KeywordType.IF):
-                self.compile_if()
-            elif self.check_next_token(TokenType.KEYWORD, token_value=KeywordType.WHILE):
-                self.compile_while()
-
-    def compile_subroutine_call(self):
-        # subroutineName
-        self.advance_and_check_token(TokenType.IDENTIFIER)
-        self.gen_identifier_content()
-
-        if self.check_next_token(TokenType.SYMBOL, "."):
-            self.compile_symbol(".")
-
-            self.advance_and_check_token(TokenType.IDENTIFIER)
-            self.gen_identifier_content()
-
-        self.compile_symbol('(')
-        self.compile_expression_list()
-        self.compile_symbol(')')
+    def compile_statements(self, statements: List[Statement]):
+        for statement in statements:
+            if isinstance(statement, LetStatement):
+                self.compile_let(statement)
+            elif isinstance(statement, DoStatement):
+                self.compile_do(statement)
+            elif isinstance(statement, ReturnStatement):
+                self.compile_return(statement)
+            elif isinstance(statement, IfStatement):
+                self.compile_if(statement)
+            elif isinstance(statement, WhileStatement):
+                self.compile_while(statement)
+
+    def compile_block(self, statements: List[Statement]):
+        self.gen_symbol_content('{')
+        self.compile_statements(statements)
+        self.gen_symbol_content('}')
+
+    def compile_condition(self, condition: Expression):
+        self.gen_symbol_content('(')
+        self.compile_expression(condition)
+        self.gen_symbol_content(')')
+
+    def compile_subroutine_call(self, call: SubroutineCall):
+        if call.receiver is not None:
+            self.gen_identifier_content(call.receiver)
+            self.gen_symbol_content(".")
+        self.gen_identifier_content(call.name)
+
+        self.gen_symbol_content('(')
+        self.compile_expression_list(call.args)
+        self.gen_symbol_content(')')
 
     @sub_element("doStatement")
-    def compile_do(self):
+    def compile_do(self, statement: DoStatement):
         """
             'do' subroutineCall ';'
-
         """
-        # do
-        self.advance_and_check_token(TokenType.KEYWORD, KeywordType.DO)
-        self.gen_keyword_content()
-
-        # subroutineCall
-        self.compile_subroutine_call()
-
-        self.compile_symbol(";")
+        self.gen_keyword_content(KeywordType.DO)
+        self.compile_subroutine_call(statement.call)
+        self.gen_symbol_content(";")
 
     @sub_element("letStatement")
-    def compile_let(self):
+    def compile_let(self, statement: LetStatement):
         """
             'let' varName ('[' expression ']')? '=' expression ';'
         """
-        self.compile_keyword(KeywordType.LET)
-
-        self.compile_var_name()
+        self.gen_keyword_content(KeywordType.LET)
+        self.gen_identifier_content(statement.name)
 
         # ('[' expression ']')?
-        if self.check_next_symbol("["):
-            self.compile_symbol("[")
-            self.compile_expression()
-            self.compile_symbol("]")
+        if statement.index is not None:
+            self.gen_symbol_content("[")
+            self.compile_expression(statement.index)
+            self.gen_symbol_content("]")
 
-        self.compile_symbol("=")
-        self.compile_expression()
-        self.compile_symbol(";")
+        self.gen_symbol_content("=")
+        self.compile_expression(statement.value)
+        self.gen_symbol_content(";")
 
     @sub_element("whileStatement")
-    def compile_while(self):
-        self.advance_and_check_token(TokenType.KEYWORD, KeywordType.WHILE)
-        self.gen_keyword_content()
-
-        self.compile_symbol('(')
-        self.compile_expression()
-        self.compile_symbol(')')
-
-        self.compile_symbol('{')
-        self.compile_statements()
-        self.compile_symbol('}')
+    def compile_while(self, statement: WhileStatement):
+        self.gen_keyword_content(KeywordType.WHILE)
+        self.compile_condition(statement.condition)
+        self.compile_block(statement.statements)
 
     @sub_element("returnStatement")
-    def compile_return(self):
+    def compile_return(self, statement: ReturnStatement):
         """
             'return' expression? ';'
         """
-        self.advance_and_check_token(TokenType.KEYWORD, KeywordType.RETURN)
-        self.gen_keyword_content()
-
-        if not self.check_next_symbol(";"):
-            self.compile_expression()
-
-        self.compile_symbol(";")
+        self.gen_keyword_content(KeywordType.RETURN)
+        if statement.value is not None:
+            self.compile_expression(statement.value)
+        self.gen_symbol_content(";")
 
     @sub_element("ifStatement")
-    def compile_if(self):
-        self.compile_keyword(KeywordType.IF)
-
-        self.compile_symbol('(')
-        self.compile_expression()
-        self.compile_symbol(')')
+    def compile_if(self, statement: IfStatement):
+        self.gen_keyword_content(KeywordType.IF)
+        self.compile_condition(statement.condition)
+        self.compile_block(statement.statements)
 
-        self.compile_symbol('{')
-        self.compile_statements()
-        self.compile_symbol('}')
-
-        if self.check_next_token(TokenType.KEYWORD, KeywordType.ELSE):
-            self.compile_keyword(KeywordType.ELSE)
-            self.compile_symbol('{')
-            self.compile_statements()
-            self.compile_symbol('}')
+        if statement.else_statements is not None:
+            self.gen_keyword_content(KeywordType.ELSE)
+            self.compile_block(statement.else_statements)
 
     @sub_element("expression")
-    def compile_expression(self):
+    def compile_expression(self, expression: Expression):
         """
-            term (op term)*
+            term (op term)*: 沿BinaryOp的左侧展开
         """
-        self.compile_term()
+        operations = []
+        while isinstance(expression, BinaryOp):
+            operations.append((expression.op, expression.right))
+            expression = expression.left
+        self.compile_term(expression)
 
         # (op term)*
-        while self.check_next_symbol(symbol_values=OpSymbols):
-            self.compile_symbol(symbol_values=OpSymbols)
-            self.compile_term()
+        for op, term in reversed(operations):
+            self.gen_symbol_content(op)
+            self.compile_term(term)
 
     @sub_element("term")
-    def compile_term(self):
-        self.tokenizer.advance()
-        if self.check_token(TokenType.IDENTIFIER):
-            self.gen_identifier_content()
-            if self.check_next_symbol("."):
-                self.compile_symbol(".")
-                self.compile_identifier()
-                self.compile_symbol("(")
-                self.compile_expression_list()
-                self.compile_symbol(")")
-            elif self.check_next_symbol("["):
-                self.compile_symbol("[")
-                self.compile_expression()
-                self.compile_symbol("]")
-        elif self.check_token(TokenType.KEYWORD):
-            self.gen_keyword_content()
-        elif self.check_token(TokenType.INT_CONST):
-            self.gen_integer_constant_content()
-        elif self.check_token(TokenType.STRING_CONST):
-            self.gen_string_constant_content()
-        elif self.check_token(TokenType.SYMBOL, '('):
-            self.gen_symbol_content()
-            self.compile_expression()
-            self.compile_symbol(")")
-        elif self.check_symbol(symbol_values=UnaryOpSymbols):
-            self.gen_symbol_content()
-            self.compile_term()
+    def compile_term(self, term: Expression):
+        if isinstance(term, VarTerm):
+            self.gen_identifier_content(term.name)
+        elif isinstance(term, SubroutineCall):
+            self.compile_subroutine_call(term)
+        elif isinstance(term, ArrayTerm):
+            self.gen_identifier_content(term.name)
+            self.gen_symbol_content("[")
+            self.compile_expression(term.index)
+            self.gen_symbol_content("]")
+        elif isinstance(term, KeywordConstant):
+            self.gen_keyword_content(term.keyword)
+        elif isinstance(term, IntegerConstant):
+            self.gen_integer_constant_content(term.value)
+        elif isinstance(term, StringConstant):
+            self.gen_string_constant_content(term.value)
+        elif isinstance(term, ParenExpression):
+            self.gen_symbol_content('(')
+            self.compile_expression(term.expression)
+            self.gen_symbol_content(")")
+        elif isinstance(term, UnaryOp):
+            self.gen_symbol_content(term.op)
+            self.compile_term(term.operand)
 
     @sub_element("expressionList")
-    def compile_expression_list(self, finish_char=')'):
+    def compile_expression_list(self, expressions: List[Expression]):
         """
             (expression (',' expression)*)?
         """
-        if self.check_next_symbol(finish_char):
+        if not expressions:
             self.current_root.text = f"\n{self.indent*'  '}"
             return
 
-        self.compile_expression()
-
-        # (',' expression)*
-        while self.check_next_symbol(","):
-            self.compile_symbol(",")
-            self.compile_expression()
+        for index, expression in enumerate(expressions):
+            if index:
+                self.gen_symbol_content(",")
+            self.compile_expression(expression)
 
 
 class JackAnalyzer:
@@ -598,20 +299,23 @@ class JackAnalyzer:
             jack_files = list(jack_path.glob("*.jack"))
             return jack_files
 
-    def __init__(self, jack_file_or_dir: str):
+    def __init__(self, jack_file_or_dir: str, use_cache: bool = True):
         self.jack_files = self.handler_jack_file_or_dir(jack_file_or_dir)
+        self.use_cache = use_cache
 
     def analyzer(self):
         for jack_file in self.jack_files:
-            jack_file_object = open(jack_file)
-            tokenizer = JackTokenizer(open(jack_file))
-            engine = CompilationEngine(tokenizer, jack_file.stem)
+            tokenizer = JackTokenizer.from_file(jack_file, self.use_cache)
+            class_dec = JackParser(tokenizer).parse()
+            if class_dec is None:
+                continue
+            engine = CompilationEngine(class_dec, jack_file.stem)
             engine.compile()
-            jack_file_object.close()
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="JackAnalyzer")
     parser.add_argument("jack_file_or_dir", type=str, help="jack file or dir path")
+    parser.add_argument("--no-cache", action="store_true", help="do not read or write the __jackcache__ token cache")
     input_args = parser.parse_args()
-    JackAnalyzer(input_args.jack_file_or_dir).analyzer()
+    JackAnalyzer(input_args.jack_file_or_dir, not input_args.no_cache).analyzer()
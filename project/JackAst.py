@@ -0,0 +1,435 @@
+import logging
+from typing import List, Optional, Tuple, Union
+
+from JackTokenizer import JackTokenizer, TokenType, KeywordType, OpSymbols, UnaryOpSymbols
+
+# 类型: int/char/boolean/void 为KeywordType, 类名为str
+JackType = Union[KeywordType, str]
+
+
+class IntegerConstant:
+    __slots__ = ("value",)
+
+    def __init__(self, value: int):
+        self.value = value
+
+
+class StringConstant:
+    __slots__ = ("value",)
+
+    def __init__(self, value: str):
+        self.value = value
+
+
+class KeywordConstant:
+    """ true/false/null/this"""
+    __slots__ = ("keyword",)
+
+    def __init__(self, keyword: KeywordType):
+        self.keyword = keyword
+
+
+class VarTerm:
+    __slots__ = ("name",)
+
+    def __init__(self, name: str):
+        self.name = name
+
+
+class ArrayTerm:
+    """ name[index]"""
+    __slots__ = ("name", "index")
+
+    def __init__(self, name: str, index: "Expression"):
+        self.name = name
+        self.index = index
+
+
+class SubroutineCall:
+    """ receiver.name(args), receiver 为None时是 name(args)"""
+    __slots__ = ("receiver", "name", "args")
+
+    def __init__(self, receiver: Optional[str], name: str, args: List["Expression"]):
+        self.receiver = receiver
+        self.name = name
+        self.args = args
+
+
+class ParenExpression:
+    """ '(' expression ')', vm代码与内部表达式相同, 只为xml保留括号"""
+    __slots__ = ("expression",)
+
+    def __init__(self, expression: "Expression"):
+        self.expression = expression
+
+
+class UnaryOp:
+    __slots__ = ("op", "operand")
+
+    def __init__(self, op: str, operand: "Expression"):
+        self.op = op
+        self.operand = operand
+
+
+class BinaryOp:
+    """ jack没有优先级, term (op term)* 从左到右结合: right 总是一个term"""
+    __slots__ = ("op", "left", "right")
+
+    def __init__(self, op: str, left: "Expression", right: "Expression"):
+        self.op = op
+        self.left = left
+        self.right = right
+
+
+Expression = Union[IntegerConstant, StringConstant, KeywordConstant, VarTerm, ArrayTerm, SubroutineCall,
+                   ParenExpression, UnaryOp, BinaryOp]
+
+
+class LetStatement:
+    __slots__ = ("line", "name", "index", "value")
+
+    def __init__(self, line: int, name: str, index: Optional[Expression], value: Expression):
+        self.line = line
+        self.name = name
+        self.index = index
+        self.value = value
+
+
+class IfStatement:
+    """ else_statements 为None表示没有else分支, 空列表表示 else {}"""
+    __slots__ = ("line", "condition", "statements", "else_statements")
+
+    def __init__(self, line: int, condition: Expression, statements: List["Statement"],
+                 else_statements: Optional[List["Statement"]]):
+        self.line = line
+        self.condition = condition
+        self.statements = statements
+        self.else_statements = else_statements
+
+
+class WhileStatement:
+    __slots__ = ("line", "condition", "statements")
+
+    def __init__(self, line: int, condition: Expression, statements: List["Statement"]):
+        self.line = line
+        self.condition = condition
+        self.statements = statements
+
+
+class DoStatement:
+    __slots__ = ("line", "call")
+
+    def __init__(self, line: int, call: SubroutineCall):
+        self.line = line
+        self.call = call
+
+
+class ReturnStatement:
+    __slots__ = ("line", "value")
+
+    def __init__(self, line: int, value: Optional[Expression]):
+        self.line = line
+        self.value = value
+
+
+Statement = Union[LetStatement, IfStatement, WhileStatement, DoStatement, ReturnStatement]
+
+
+class VarDec:
+    """ 一条声明语句: var type name (',' name)* ';', kind 为 STATIC/FIELD/VAR"""
+    __slots__ = ("kind", "type", "names")
+
+    def __init__(self, kind: KeywordType, type: JackType, names: List[str]):
+        self.kind = kind
+        self.type = type
+        self.names = names
+
+
+class SubroutineDec:
+    __slots__ = ("line", "kind", "return_type", "name", "parameters", "var_decs", "statements")
+
+    def __init__(self, line: int, kind: KeywordType, return_type: JackType, name: str,
+                 parameters: List[Tuple[JackType, str]], var_decs: List[VarDec], statements: List[Statement]):
+        self.line = line
+        self.kind = kind
+        self.return_type = return_type
+        self.name = name
+        self.parameters = parameters
+        self.var_decs = var_decs
+        self.statements = statements
+
+
+class ClassDec:
+    __slots__ = ("name", "var_decs", "subroutines")
+
+    def __init__(self, name: str, var_decs: List[VarDec], subroutines: List[SubroutineDec]):
+        self.name = name
+        self.var_decs = var_decs
+        self.subroutines = subroutines
+
+
+class JackParser:
+    """
+        递归下降解析一个jack类, 生成语法树; vm和xml后端都只遍历语法树, 不再直接读token.
+    """
+    TypeKeywords = {KeywordType.VOID, KeywordType.INT, KeywordType.CHAR, KeywordType.BOOLEAN}
+    ClassVarKeywords = {KeywordType.STATIC, KeywordType.FIELD}
+    SubroutineKeywords = {KeywordType.CONSTRUCTOR, KeywordType.FUNCTION, KeywordType.METHOD}
+    StatementKeywords = {KeywordType.LET, KeywordType.IF, KeywordType.WHILE, KeywordType.DO, KeywordType.RETURN}
+
+    def __init__(self, tokenizer: JackTokenizer):
+        self.tokenizer = tokenizer
+
+    @property
+    def token_value(self):
+        return self.tokenizer.token_value
+
+    def advance_and_check_token(self, token_type: TokenType, token_value=None, token_values=None):
+        self.tokenizer.advance()
+        if token_type != self.tokenizer.token_type:
+            raise Exception(f"expect token_type[{token_type}] get token_type[{self.tokenizer.token_type}]")
+        if token_value is not None and self.token_value != token_value:
+            raise Exception(f"expect token_value[{token_value}] get token_value[{self.token_value}]")
+        if token_values is not None and self.token_value not in token_values:
+            raise Exception(f"expect token_values in [{token_values}] get token_value[{self.token_value}]")
+
+    def check_next_token(self, token_type: TokenType, token_value=None, token_values=None) -> bool:
+        if token_type != self.tokenizer.next_token_type:
+            return False
+        if token_value is not None and self.tokenizer.next_token_value != token_value:
+            return False
+        if token_values is not None and self.tokenizer.next_token_value not in token_values:
+            return False
+        return True
+
+    def check_next_symbol(self, symbol_value=None, symbol_values=None) -> bool:
+        return self.check_next_token(TokenType.SYMBOL, symbol_value, symbol_values)
+
+    def parse_symbol(self, symbol_value=None, symbol_values=None) -> str:
+        self.advance_and_check_token(TokenType.SYMBOL, symbol_value, symbol_values)
+        return self.token_value
+
+    def parse_keyword(self, keyword=None, keywords=None) -> KeywordType:
+        self.advance_and_check_token(TokenType.KEYWORD, keyword, keywords)
+        return self.token_value
+
+    def parse_identifier(self) -> str:
+        self.advance_and_check_token(TokenType.IDENTIFIER)
+        return self.token_value
+
+    def parse_type(self) -> JackType:
+        self.tokenizer.advance()
+        if self.tokenizer.token_type == TokenType.IDENTIFIER or (
+                self.tokenizer.token_type == TokenType.KEYWORD and self.token_value in self.TypeKeywords):
+            return self.token_value
+        raise Exception(f"expect type get token_value[{self.token_value}]")
+
+    def parse(self) -> Optional[ClassDec]:
+        """ 出错时打印错误和行号, 返回None"""
+        try:
+            return self.parse_class()
+        except Exception as error:
+            logging.exception(error)
+            print(f"**************line_num={self.tokenizer.line_num} {error}")
+            return None
+
+    def parse_class(self) -> ClassDec:
+        """
+            'class' className '{' classVarDec* subroutineDec* '}'
+        """
+        self.parse_keyword(KeywordType.CLASS)
+        class_name = self.parse_identifier()
+        self.parse_symbol('{')
+
+        var_decs = []
+        while self.check_next_token(TokenType.KEYWORD, token_values=self.ClassVarKeywords):
+            var_decs.append(self.parse_var_dec(self.ClassVarKeywords))
+
+        subroutines = []
+        while self.check_next_token(TokenType.KEYWORD, token_values=self.SubroutineKeywords):
+            subroutines.append(self.parse_subroutine())
+
+        self.parse_symbol('}')
+        return ClassDec(class_name, var_decs, subroutines)
+
+    def parse_var_dec(self, kinds) -> VarDec:
+        """
+            ('static'|'field'|'var') type varName (',' varName)* ';'
+        """
+        kind = self.parse_keyword(keywords=kinds)
+        var_type = self.parse_type()
+        names = [self.parse_identifier()]
+        while self.check_next_symbol(","):
+            self.parse_symbol(",")
+            names.append(self.parse_identifier())
+        self.parse_symbol(";")
+        return VarDec(kind, var_type, names)
+
+    def parse_subroutine(self) -> SubroutineDec:
+        """
+            ('constructor' | 'function' | 'method') ('void'|type) subroutineName '(' parameterList ')' subroutineBody
+            subroutineBody: '{' varDec* statements '}'
+        """
+        kind = self.parse_keyword(keywords=self.SubroutineKeywords)
+        line = self.tokenizer.line_num
+        return_type = self.parse_type()
+        name = self.parse_identifier()
+
+        self.parse_symbol('(')
+        parameters = self.parse_parameter_list()
+        self.parse_symbol(')')
+
+        self.parse_symbol('{')
+        var_decs = []
+        while self.check_next_token(TokenType.KEYWORD, KeywordType.VAR):
+            var_decs.append(self.parse_var_dec({KeywordType.VAR}))
+        statements = self.parse_statements()
+        self.parse_symbol('}')
+        return SubroutineDec(line, kind, return_type, name, parameters, var_decs, statements)
+
+    def parse_parameter_list(self) -> List[Tuple[JackType, str]]:
+        """
+            ((type varName)(',' type varName)*)?
+        """
+        parameters = []
+        if self.check_next_symbol(')'):
+            return parameters
+
+        parameters.append((self.parse_type(), self.parse_identifier()))
+        while self.check_next_symbol(','):
+            self.parse_symbol(',')
+            parameters.append((self.parse_type(), self.parse_identifier()))
+        return parameters
+
+    def parse_statements(self) -> List[Statement]:
+        statements = []
+        while self.check_next_token(TokenType.KEYWORD, token_values=self.StatementKeywords):
+            keyword = self.parse_keyword()
+            line = self.tokenizer.line_num
+            if keyword == KeywordType.LET:
+                statements.append(self.parse_let(line))
+            elif keyword == KeywordType.DO:
+                statements.append(DoStatement(line, self.parse_subroutine_call(self.parse_identifier())))
+                self.parse_symbol(";")
+            elif keyword == KeywordType.RETURN:
+                statements.append(self.parse_return(line))
+            elif keyword == KeywordType.IF:
+                statements.append(self.parse_if(line))
+            elif keyword == KeywordType.WHILE:
+                condition = self.parse_condition()
+                statements.append(WhileStatement(line, condition, self.parse_block()))
+        return statements
+
+    def parse_block(self) -> List[Statement]:
+        self.parse_symbol('{')
+        statements = self.parse_statements()
+        self.parse_symbol('}')
+        return statements
+
+    def parse_condition(self) -> Expression:
+        self.parse_symbol('(')
+        condition = self.parse_expression()
+        self.parse_symbol(')')
+        return condition
+
+    def parse_let(self, line: int) -> LetStatement:
+        """
+            'let' varName ('[' expression ']')? '=' expression ';'
+        """
+        name = self.parse_identifier()
+        index = None
+        if self.check_next_symbol("["):
+            self.parse_symbol("[")
+            index = self.parse_expression()
+            self.parse_symbol("]")
+        self.parse_symbol("=")
+        value = self.parse_expression()
+        self.parse_symbol(";")
+        return LetStatement(line, name, index, value)
+
+    def parse_if(self, line: int) -> IfStatement:
+        """
+            'if' '(' expression ')' '{' statements '}' ('else' '{' statements '}')?
+        """
+        condition = self.parse_condition()
+        statements = self.parse_block()
+        else_statements = None
+        if self.check_next_token(TokenType.KEYWORD, KeywordType.ELSE):
+            self.parse_keyword(KeywordType.ELSE)
+            else_statements = self.parse_block()
+        return IfStatement(line, condition, statements, else_statements)
+
+    def parse_return(self, line: int) -> ReturnStatement:
+        """
+            'return' expression? ';'
+        """
+        value = None
+        if not self.check_next_symbol(";"):
+            value = self.parse_expression()
+        self.parse_symbol(";")
+        return ReturnStatement(line, value)
+
+    def parse_subroutine_call(self, name: str) -> SubroutineCall:
+        """
+            subroutineName '(' expressionList ')' | (className|varName) '.' subroutineName '(' expressionList ')'
+            name 为已经读入的第一个标识符
+        """
+        receiver = None
+        if self.check_next_symbol("."):
+            self.parse_symbol(".")
+            receiver, name = name, self.parse_identifier()
+        self.parse_symbol('(')
+        args = self.parse_expression_list()
+        self.parse_symbol(')')
+        return SubroutineCall(receiver, name, args)
+
+    def parse_expression(self) -> Expression:
+        """
+            term (op term)*
+        """
+        expression = self.parse_term()
+        while self.check_next_symbol(symbol_values=OpSymbols):
+            op = self.parse_symbol()
+            expression = BinaryOp(op, expression, self.parse_term())
+        return expression
+
+    def parse_term(self) -> Expression:
+        self.tokenizer.advance()
+        token_type = self.tokenizer.token_type
+        token_value = self.token_value
+        if token_type == TokenType.IDENTIFIER:
+            if self.check_next_symbol("."):
+                return self.parse_subroutine_call(token_value)
+            elif self.check_next_symbol("["):
+                self.parse_symbol("[")
+                index = self.parse_expression()
+                self.parse_symbol("]")
+                return ArrayTerm(token_value, index)
+            return VarTerm(token_value)
+        elif token_type == TokenType.KEYWORD:
+            return KeywordConstant(token_value)
+        elif token_type == TokenType.INT_CONST:
+            return IntegerConstant(token_value)
+        elif token_type == TokenType.STRING_CONST:
+            return StringConstant(token_value)
+        elif token_type == TokenType.SYMBOL and token_value == '(':
+            expression = self.parse_expression()
+            self.parse_symbol(")")
+            return ParenExpression(expression)
+        elif token_type == TokenType.SYMBOL and token_value in UnaryOpSymbols:
+            return UnaryOp(token_value, self.parse_term())
+        raise Exception(f"expect term get token_value[{token_value}]")
+
+    def parse_expression_list(self) -> List[Expression]:
+        """
+            (expression (',' expression)*)?
+        """
+        expressions = []
+        if self.check_next_symbol(')'):
+            return expressions
+
+        expressions.append(self.parse_expression())
+        while self.check_next_symbol(","):
+            self.parse_symbol(",")
+            expressions.append(self.parse_expression())
+        return expressions
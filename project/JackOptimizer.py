@@ -0,0 +1,141 @@
+from typing import Callable, Dict, List, Optional
+
+from JackAst import (ClassDec, Statement, LetStatement, IfStatement, WhileStatement, DoStatement, ReturnStatement,
+                     Expression, BinaryOp, UnaryOp, ParenExpression, VarTerm, ArrayTerm, SubroutineCall,
+                     KeywordConstant, IntegerConstant)
+from JackTokenizer import KeywordType
+
+
+def to_signed(value: int) -> int:
+    value &= 0xFFFF
+    return value - 0x10000 if value & 0x8000 else value
+
+
+def divide(x: int, y: int) -> Optional[int]:
+    """ 与 Math.divide 一致向0取整; 除0和-32768不折叠, 留给运行时"""
+    if y == 0 or x == -0x8000 or y == -0x8000:
+        return None
+    quotient = abs(x) // abs(y)
+    return quotient if (x < 0) == (y < 0) else -quotient
+
+
+class ConstantFolder:
+    """
+        jack层的常数折叠, 直接改写语法树中的表达式:
+            两边都是常数的运算在编译时算出, 结果按16位有符号数保存(可能为负, 由vm后端生成 push/neg);
+            去掉 x+0, x-0, x*1, x/1, x|0, x&-1 等恒等式, 没有副作用的 x*0 变为0;
+            常数在左边的乘法交换到右边, 便于后端把乘常数改写为加法.
+        括号在vm代码中没有作用, 折叠时一并去掉, 所以只用于生成vm, 不用于xml.
+    """
+    BINARY_OPERATIONS: Dict[str, Callable[[int, int], Optional[int]]] = {
+        '+': lambda x, y: x + y,
+        '-': lambda x, y: x - y,
+        '*': lambda x, y: x * y,
+        '/': divide,
+        '&': lambda x, y: x & y,
+        '|': lambda x, y: x | y,
+        # 与生成的汇编一致: 比较的是16位溢出后的 x-y
+        '=': lambda x, y: -1 if to_signed(x - y) == 0 else 0,
+        '>': lambda x, y: -1 if to_signed(x - y) > 0 else 0,
+        '<': lambda x, y: -1 if to_signed(x - y) < 0 else 0,
+    }
+    UNARY_OPERATIONS: Dict[str, Callable[[int], int]] = {
+        '-': lambda x: -x,
+        '~': lambda x: ~x,
+    }
+    # (op, 常数): 常数在右边/左边时运算结果就是另一边的值
+    RIGHT_IDENTITIES = {('+', 0), ('-', 0), ('*', 1), ('/', 1), ('|', 0), ('&', -1)}
+    LEFT_IDENTITIES = {('+', 0), ('*', 1), ('|', 0), ('&', -1)}
+
+    @staticmethod
+    def constant_value(expression: Expression) -> Optional[int]:
+        if isinstance(expression, IntegerConstant):
+            return expression.value
+        if isinstance(expression, KeywordConstant):
+            if expression.keyword == KeywordType.TRUE:
+                return -1
+            if expression.keyword in (KeywordType.FALSE, KeywordType.NULL):
+                return 0
+        return None
+
+    @classmethod
+    def is_pure(cls, expression: Expression) -> bool:
+        """ 求值没有副作用(不调用函数), 去掉后不影响程序"""
+        if isinstance(expression, (IntegerConstant, KeywordConstant, VarTerm)):
+            return True
+        if isinstance(expression, ArrayTerm):
+            return cls.is_pure(expression.index)
+        if isinstance(expression, UnaryOp):
+            return cls.is_pure(expression.operand)
+        if isinstance(expression, BinaryOp):
+            return cls.is_pure(expression.left) and cls.is_pure(expression.right)
+        return False
+
+    def run(self, class_dec: ClassDec):
+        for subroutine in class_dec.subroutines:
+            self.fold_statements(subroutine.statements)
+
+    def fold_statements(self, statements: List[Statement]):
+        for statement in statements:
+            if isinstance(statement, LetStatement):
+                if statement.index is not None:
+                    statement.index = self.fold(statement.index)
+                statement.value = self.fold(statement.value)
+            elif isinstance(statement, DoStatement):
+                self.fold_call(statement.call)
+            elif isinstance(statement, ReturnStatement):
+                if statement.value is not None:
+                    statement.value = self.fold(statement.value)
+            elif isinstance(statement, IfStatement):
+                statement.condition = self.fold(statement.condition)
+                self.fold_statements(statement.statements)
+                if statement.else_statements is not None:
+                    self.fold_statements(statement.else_statements)
+            elif isinstance(statement, WhileStatement):
+                statement.condition = self.fold(statement.condition)
+                self.fold_statements(statement.statements)
+
+    def fold_call(self, call: SubroutineCall):
+        call.args = [self.fold(arg) for arg in call.args]
+
+    def fold(self, expression: Expression) -> Expression:
+        if isinstance(expression, ParenExpression):
+            return self.fold(expression.expression)
+        if isinstance(expression, ArrayTerm):
+            expression.index = self.fold(expression.index)
+        elif isinstance(expression, SubroutineCall):
+            self.fold_call(expression)
+        elif isinstance(expression, UnaryOp):
+            expression.operand = self.fold(expression.operand)
+            value = self.constant_value(expression.operand)
+            if value is not None:
+                return IntegerConstant(to_signed(self.UNARY_OPERATIONS[expression.op](value)))
+        elif isinstance(expression, BinaryOp):
+            return self.fold_binary(expression)
+        return expression
+
+    def fold_binary(self, expression: BinaryOp) -> Expression:
+        expression.left = self.fold(expression.left)
+        expression.right = self.fold(expression.right)
+        op = expression.op
+        left = self.constant_value(expression.left)
+        right = self.constant_value(expression.right)
+
+        if left is not None and right is not None:
+            value = self.BINARY_OPERATIONS[op](left, right)
+            if value is not None:
+                return IntegerConstant(to_signed(value))
+        elif right is not None:
+            if (op, right) in self.RIGHT_IDENTITIES:
+                return expression.left
+            if op == '*' and right == 0 and self.is_pure(expression.left):
+                return IntegerConstant(0)
+        elif left is not None:
+            if (op, left) in self.LEFT_IDENTITIES:
+                return expression.right
+            if op == '*':
+                if left == 0 and self.is_pure(expression.right):
+                    return IntegerConstant(0)
+                # 常数没有副作用, 交换求值顺序不影响结果
+                expression.left, expression.right = expression.right, expression.left
+        return expression
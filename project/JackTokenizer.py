@@ -0,0 +1,244 @@
+import hashlib
+import marshal
+import re
+from array import array
+from enum import IntEnum
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+
+class TokenType(IntEnum):
+    KEYWORD = 1
+    SYMBOL = 2
+    IDENTIFIER = 3
+    INT_CONST = 4
+    STRING_CONST = 5
+
+
+class KeywordType(IntEnum):
+    CLASS = 1
+    METHOD = 2
+    INT = 3
+    FUNCTION = 4
+    BOOLEAN = 5
+    CONSTRUCTOR = 6
+    CHAR = 7
+    VOID = 8
+    VAR = 9
+    STATIC = 10
+    FIELD = 11
+    LET = 12
+    DO = 13
+    IF = 14
+    ELSE = 15
+    WHILE = 16
+    RETURN = 17
+    TRUE = 18
+    FALSE = 19
+    NULL = 20
+    THIS = 21
+
+
+Str2KeywordType: Dict[str, KeywordType] = {
+    "class": KeywordType.CLASS,
+    "constructor": KeywordType.CONSTRUCTOR,
+    "function": KeywordType.FUNCTION,
+    "method": KeywordType.METHOD,
+    "field": KeywordType.FIELD,
+    "static": KeywordType.STATIC,
+    "var": KeywordType.VAR,
+    "int": KeywordType.INT,
+    "char": KeywordType.CHAR,
+    "boolean": KeywordType.BOOLEAN,
+    "void": KeywordType.VOID,
+    "true": KeywordType.TRUE,
+    "false": KeywordType.FALSE,
+    "null": KeywordType.NULL,
+    "this": KeywordType.THIS,
+    "let": KeywordType.LET,
+    "do": KeywordType.DO,
+    "if": KeywordType.IF,
+    "else": KeywordType.ELSE,
+    "while": KeywordType.WHILE,
+    "return": KeywordType.RETURN
+}
+
+KeywordType2Str: Dict[KeywordType, str] = {value: key for key, value in Str2KeywordType.items()}
+KeyWords = set(Str2KeywordType.keys())
+
+Symbols = set("{}()[].,;+-*/&|<>=~")
+OpSymbols = set("+-*/&|<>=")
+UnaryOpSymbols = set('-~')
+
+# 缓存中类型/关键字按整数保存, 读回时查表还原成枚举
+Int2TokenType: Dict[int, TokenType] = {int(token_type): token_type for token_type in TokenType}
+Int2KeywordType: Dict[int, KeywordType] = {int(keyword): keyword for keyword in KeywordType}
+
+
+class JackTokenizer:
+    """
+        一次读入整个源文件, 用一个总的正则表达式扫描出token数组, 之后按下标前进.
+        types/values/lines 三个数组按下标对应同一个token, reset 只需把下标归零.
+        from_file 按文件内容的哈希把token数组缓存到源文件旁的 __jackcache__ 目录, 内容不变时跳过扫描.
+    """
+    TOKEN_PATTERN = re.compile(r"""
+        (?P<word>[A-Za-z_][A-Za-z0-9_]*)
+        |(?P<space>\s+)
+        |(?P<line_comment>//[^\n]*)
+        |(?P<block_comment>/\*[\s\S]*?(?:\*/|\Z))
+        |(?P<symbol>[{}()\[\].,;+\-*/&|<>=~])
+        |(?P<integer>[0-9]+)
+        |(?P<string>"[^"]*")
+        |(?P<error>.)
+    """, re.VERBOSE)
+
+    CACHE_DIR = "__jackcache__"
+    CACHE_SUFFIX = ".tokens"
+    CACHE_VERSION = b"1"  # token数组格式或扫描规则变化时修改, 使旧缓存失效
+
+    def __init__(self, types: List[Optional[TokenType]], values: list, lines: array):
+        self.types = types
+        self.values = values
+        self.lines = lines
+        self.position = -1
+
+    @classmethod
+    def from_source(cls, source: str) -> "JackTokenizer":
+        return cls(*cls.tokenize(source))
+
+    @classmethod
+    def from_file(cls, jack_file: Path, use_cache: bool = True) -> "JackTokenizer":
+        content = jack_file.read_bytes()
+        if not use_cache:
+            return cls.from_source(content.decode())
+
+        digest = hashlib.sha1(cls.CACHE_VERSION + content).hexdigest()[:16]
+        cache_dir = jack_file.parent / cls.CACHE_DIR
+        cache_file = cache_dir / f"{jack_file.stem}.{digest}{cls.CACHE_SUFFIX}"
+        try:
+            return cls(*cls.loads(cache_file.read_bytes()))
+        except (OSError, EOFError, ValueError, TypeError, KeyError):
+            pass
+
+        tokens = cls.tokenize(content.decode())
+        try:
+            cache_dir.mkdir(exist_ok=True)
+            # 同一源文件旧内容的缓存不再有用
+            for stale_file in cache_dir.glob(f"{jack_file.stem}.*{cls.CACHE_SUFFIX}"):
+                stale_file.unlink()
+            cache_file.write_bytes(cls.dumps(*tokens))
+        except OSError:
+            pass  # 目录只读等情况下不使用缓存
+        return cls(*tokens)
+
+    @classmethod
+    def tokenize(cls, source: str) -> Tuple[List[Optional[TokenType]], list, array]:
+        """ 末尾追加一个None哨兵: 下标-1(第一次advance之前)和越过最后一个token时类型都为None"""
+        types = []
+        values = []
+        lines = array('I')
+        line = 1
+        for match in cls.TOKEN_PATTERN.finditer(source):
+            kind = match.lastgroup
+            text = match.group()
+            if kind == "word":
+                keyword = Str2KeywordType.get(text)
+                if keyword is None:
+                    types.append(TokenType.IDENTIFIER)
+                    values.append(text)
+                else:
+                    types.append(TokenType.KEYWORD)
+                    values.append(keyword)
+            elif kind == "symbol":
+                types.append(TokenType.SYMBOL)
+                values.append(text)
+            elif kind == "integer":
+                types.append(TokenType.INT_CONST)
+                values.append(int(text))
+            elif kind == "string":
+                types.append(TokenType.STRING_CONST)
+                values.append(text[1:-1])
+            elif kind == "error":
+                raise Exception(f"unexpected character {text!r} at line {line}")
+            else:
+                # 空白和注释只用于计算行号
+                line += text.count("\n")
+                continue
+            lines.append(line)
+            if kind == "string":
+                line += text.count("\n")
+        types.append(None)
+        values.append(None)
+        lines.append(line)
+        return types, values, lines
+
+    @staticmethod
+    def dumps(types: List[Optional[TokenType]], values: list, lines: array) -> bytes:
+        """ 去掉哨兵, 枚举转成整数后用marshal序列化"""
+        return marshal.dumps((
+            bytes(types[:-1]),
+            [int(value) if token_type == TokenType.KEYWORD else value
+             for token_type, value in zip(types, values[:-1])],
+            lines.tobytes(),
+        ))
+
+    @staticmethod
+    def loads(data: bytes) -> Tuple[List[Optional[TokenType]], list, array]:
+        raw_types, raw_values, raw_lines = marshal.loads(data)
+        types: List[Optional[TokenType]] = [Int2TokenType[token_type] for token_type in raw_types]
+        values = [Int2KeywordType[value] if token_type == TokenType.KEYWORD else value
+                  for token_type, value in zip(types, raw_values)]
+        lines = array('I')
+        lines.frombytes(raw_lines)
+        if not (len(types) == len(values) == len(lines) - 1):
+            raise ValueError("corrupted token cache")
+        types.append(None)
+        values.append(None)
+        return types, values, lines
+
+    def reset(self):
+        self.position = -1
+
+    def advance(self):
+        if self.position < len(self.types) - 1:
+            self.position += 1
+
+    @property
+    def line_num(self) -> int:
+        return self.lines[max(self.position, 0)]
+
+    @property
+    def next_token_type(self) -> Optional[TokenType]:
+        return self.types[self.position + 1]
+
+    @property
+    def next_token_value(self):
+        return self.values[self.position + 1]
+
+    @property
+    def token_type(self) -> Optional[TokenType]:
+        return self.types[self.position]
+
+    @property
+    def token_value(self):
+        return self.values[self.position]
+
+    @property
+    def keyword(self) -> KeywordType:
+        return self.token_value
+
+    @property
+    def symbol(self) -> str:
+        return self.token_value
+
+    @property
+    def identifier(self) -> str:
+        return self.token_value
+
+    @property
+    def int_value(self) -> int:
+        return self.token_value
+
+    @property
+    def string_value(self) -> str:
+        return self.token_value
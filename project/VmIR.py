@@ -0,0 +1,207 @@
+from enum import IntEnum
+from typing import Dict, List, Optional, Union, Tuple
+
+
+class CommandType(IntEnum):
+    C_ARITHMETIC = 1
+    C_PUSH = 2
+    C_POP = 3
+    C_LABEL = 4
+    C_GOTO = 5
+    C_IF = 6
+    C_FUNCTION = 7
+    C_RETURN = 8
+    C_CALL = 9
+    # 超级指令: 由优化pass把常见的命令序列融合而成, parts保存原来的命令
+    C_MOVE = 10         # push X / pop Y
+    C_INC = 11          # push X / push constant c / add|sub / pop X
+    C_DEREF = 12        # pop pointer 1 / push that 0
+    C_STORE_THAT = 13   # pop temp 0 / pop pointer 1 / push temp 0 / pop that 0
+    C_IF_COMPARE = 14   # eq|gt|lt / (not) / if-goto
+    C_TAILCALL = 15     # call f n / return
+
+
+class SegmentType(IntEnum):
+    S_ARGUMENT = 1      # 函数参数
+    S_LOCAL = 2         # 函数局部变量
+    S_STATIC = 3        # 同一vm文件所有函数共享的静态变量
+    S_CONSTANT = 4      # 所有常数的伪段(0~32767)
+    S_THIS = 5          # 通用段
+    S_THAT = 6          # 通用段
+    S_POINTER = 7       # 保存this/that的段基地址
+    S_TEMP = 8          # 保存临时变量(R5 ~ R12)
+    S_INLINE = 9        # 仅在IR中出现: 内联后被调函数的参数/局部变量, 全局共享的 $inline.i 变量
+
+
+Str2SegmentTypeMap: Dict[str, SegmentType] = {
+    "argument": SegmentType.S_ARGUMENT,
+    "local": SegmentType.S_LOCAL,
+    "static": SegmentType.S_STATIC,
+    "constant": SegmentType.S_CONSTANT,
+    "this": SegmentType.S_THIS,
+    "that": SegmentType.S_THAT,
+    "pointer": SegmentType.S_POINTER,
+    "temp": SegmentType.S_TEMP
+}
+
+SegmentType2StrMap: Dict[SegmentType, str] = {segment: name for name, segment in Str2SegmentTypeMap.items()}
+SegmentType2StrMap[SegmentType.S_INLINE] = "inline"
+
+
+SegmentType2LocalStrMap: Dict[SegmentType, str] = {
+    SegmentType.S_LOCAL: "LCL",
+    SegmentType.S_ARGUMENT: "ARG",
+    SegmentType.S_THIS: "THIS",
+    SegmentType.S_THAT: "THAT",
+}
+
+
+class ArithmeticType(IntEnum):
+    A_ADD = 1
+    A_SUB = 2
+    A_NEG = 3
+    A_EQ = 4
+    A_GT = 5
+    A_LT = 6
+    A_AND = 7
+    A_OR = 8
+    A_NOT = 9
+
+
+Str2ArithmeticMap: Dict[str, ArithmeticType] = {
+    "add": ArithmeticType.A_ADD,
+    "sub": ArithmeticType.A_SUB,
+    "neg": ArithmeticType.A_NEG,
+    "eq": ArithmeticType.A_EQ,
+    "gt": ArithmeticType.A_GT,
+    "lt": ArithmeticType.A_LT,
+    "and": ArithmeticType.A_AND,
+    "or": ArithmeticType.A_OR,
+    "not": ArithmeticType.A_NOT
+}
+
+ArithmeticType2StrMap: Dict[ArithmeticType, str] = {command: name for name, command in Str2ArithmeticMap.items()}
+
+ArithmeticType2OptStr: Dict[ArithmeticType, str] = {
+    ArithmeticType.A_ADD: '+',
+    ArithmeticType.A_SUB: '-',
+    ArithmeticType.A_AND: '&',
+    ArithmeticType.A_OR: '|',
+    ArithmeticType.A_EQ: 'EQ',
+    ArithmeticType.A_GT: 'GT',
+    ArithmeticType.A_LT: 'LT',
+}
+
+CommandType2StrMap: Dict[CommandType, str] = {
+    CommandType.C_PUSH: "push",
+    CommandType.C_POP: "pop",
+    CommandType.C_LABEL: "label",
+    CommandType.C_GOTO: "goto",
+    CommandType.C_IF: "if-goto",
+    CommandType.C_FUNCTION: "function",
+    CommandType.C_CALL: "call",
+    CommandType.C_RETURN: "return",
+}
+
+
+class VmCommand:
+    """
+        解析后的vm命令:
+            push/pop: arg1为SegmentType, arg2为下标
+            arithmetic: arg1为ArithmeticType
+            label/goto/if-goto: arg1为标签
+            function/call: arg1为函数名, arg2为局部变量/参数个数
+            超级指令: parts为被融合的原命令, arg1/arg2 为 C_MOVE/C_INC 的目标段和下标, C_IF_COMPARE 的标签,
+                      C_TAILCALL 的函数名和参数个数
+        text为源文件中的命令文本, 优化生成的新命令为None, 输出时按字段重新拼出.
+    """
+    __slots__ = ("command_type", "arg1", "arg2", "text", "parts")
+
+    def __init__(self, command_type: CommandType, arg1: Union[SegmentType, ArithmeticType, str, None] = None,
+                 arg2: int = 0, text: Optional[str] = None, parts: Optional[Tuple["VmCommand", ...]] = None):
+        self.command_type = command_type
+        self.arg1 = arg1
+        self.arg2 = arg2
+        self.text = text
+        self.parts = parts
+
+    def __str__(self) -> str:
+        if self.text is not None:
+            return self.text
+        if self.parts:
+            return " / ".join(str(part) for part in self.parts)
+        if self.command_type == CommandType.C_ARITHMETIC:
+            return ArithmeticType2StrMap[self.arg1]
+        name = CommandType2StrMap[self.command_type]
+        if self.command_type in (CommandType.C_PUSH, CommandType.C_POP):
+            return f"{name} {SegmentType2StrMap[self.arg1]} {self.arg2}"
+        if self.command_type in (CommandType.C_FUNCTION, CommandType.C_CALL):
+            return f"{name} {self.arg1} {self.arg2}"
+        if self.command_type == CommandType.C_RETURN:
+            return name
+        return f"{name} {self.arg1}"
+
+    def __repr__(self) -> str:
+        return f"VmCommand({self})"
+
+    def is_jump(self) -> bool:
+        return self.command_type in (CommandType.C_GOTO, CommandType.C_IF, CommandType.C_RETURN, CommandType.C_IF_COMPARE,
+                                     CommandType.C_TAILCALL)
+
+    def jump_label(self) -> Optional[str]:
+        """ 跳转到函数内标签的命令(goto/if-goto/融合的比较跳转)返回目标标签, 其他命令返回None"""
+        if self.command_type in (CommandType.C_GOTO, CommandType.C_IF, CommandType.C_IF_COMPARE):
+            return self.arg1
+        return None
+
+
+class VmFunction:
+    """ 一个vm函数的命令序列, 文件开头第一个function之前的命令归入name为None的函数"""
+    __slots__ = ("name", "num_locals", "commands")
+
+    def __init__(self, name: Optional[str], num_locals: int = 0):
+        self.name = name
+        self.num_locals = num_locals
+        self.commands: List[VmCommand] = []
+
+    def basic_blocks(self) -> List[List[VmCommand]]:
+        """ 标签开始新块, goto/if-goto/return 结束当前块"""
+        blocks: List[List[VmCommand]] = []
+        block: List[VmCommand] = []
+        for command in self.commands:
+            if command.command_type == CommandType.C_LABEL and block:
+                blocks.append(block)
+                block = []
+            block.append(command)
+            if command.is_jump():
+                blocks.append(block)
+                block = []
+        if block:
+            blocks.append(block)
+        return blocks
+
+    def set_basic_blocks(self, blocks: List[List[VmCommand]]):
+        self.commands = [command for block in blocks for command in block]
+
+
+class VmFile:
+    """ 一个vm文件, 文件名决定static段的命名空间"""
+    __slots__ = ("filename", "functions")
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.functions: List[VmFunction] = []
+
+
+class VmProgram:
+    __slots__ = ("files", "inline_sites")
+
+    def __init__(self):
+        self.files: List[VmFile] = []
+        self.inline_sites = 0  # InlinePass 已展开的位置数, 用作标签后缀
+
+    def functions(self) -> List[VmFunction]:
+        return [function for vm_file in self.files for function in vm_file.functions]
+
+    def command_count(self) -> int:
+        return sum(len(function.commands) for function in self.functions())
@@ -0,0 +1,541 @@
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Iterable, Type, Callable
+
+from VmIR import (CommandType, SegmentType, ArithmeticType, VmCommand, VmProgram, VmFunction,
+                  SegmentType2StrMap, ArithmeticType2StrMap, CommandType2StrMap)
+
+
+class VmPass:
+    """ vm到vm的优化pass, 子类实现run_function或整体覆盖run, changed记录本次改动的命令数"""
+    name = ""
+    description = ""
+
+    def __init__(self):
+        self.changed = 0
+        # 由翻译器提供: 估算一组函数翻译成asm后的指令数, 用于报告节省的ROM
+        self.measure: Optional[Callable[[List[VmFunction]], int]] = None
+
+    def run(self, program: VmProgram):
+        for function in program.functions():
+            self.run_function(function)
+
+    def run_function(self, function: VmFunction):
+        pass
+
+    def report(self) -> str:
+        return f"{self.changed} commands changed"
+
+
+class IdiomStatistics:
+    """
+        统计基本块内连续命令序列的出现次数, 用于挑选值得融合的超级指令.
+        下标按出现顺序抽象为 a/b/c..., 相同的下标得到相同的字母; 常数只保留0和1.
+    """
+    SKIPPED = (CommandType.C_LABEL, CommandType.C_FUNCTION)
+
+    def __init__(self, lengths: Iterable[int] = (2, 3, 4)):
+        self.lengths = tuple(lengths)
+        self.counts: Counter = Counter()
+
+    @staticmethod
+    def normalize(window: List[VmCommand]) -> str:
+        names: Dict[tuple, str] = {}
+        parts = []
+        for command in window:
+            if command.command_type == CommandType.C_ARITHMETIC:
+                parts.append(ArithmeticType2StrMap[command.arg1])
+            elif command.command_type in (CommandType.C_PUSH, CommandType.C_POP):
+                segment = SegmentType2StrMap[command.arg1]
+                if command.arg1 == SegmentType.S_CONSTANT:
+                    index = str(command.arg2) if command.arg2 in (0, 1) else "c"
+                else:
+                    index = names.setdefault((command.arg1, command.arg2), "abcdefgh"[min(len(names), 7)])
+                parts.append(f"{CommandType2StrMap[command.command_type]} {segment} {index}")
+            elif command.command_type == CommandType.C_CALL:
+                parts.append("call")
+            else:
+                parts.append(CommandType2StrMap.get(command.command_type, str(command)))
+        return " / ".join(parts)
+
+    def collect(self, program: VmProgram):
+        for function in program.functions():
+            for block in function.basic_blocks():
+                block = [command for command in block if command.command_type not in self.SKIPPED]
+                for length in self.lengths:
+                    for start in range(len(block) - length + 1):
+                        self.counts[self.normalize(block[start:start + length])] += 1
+
+    def report(self, top: int = 20) -> str:
+        lines = [f"{'count':>8}  idiom"]
+        lines += [f"{count:>8}  {idiom}" for idiom, count in self.counts.most_common(top)]
+        return "\n".join(lines)
+
+
+class PassManager:
+    """
+        按给定顺序执行开启的pass, 记录每个pass的耗时和改动.
+        PASSES 为所有可用pass, 新pass用 @PassManager.register 注册.
+    """
+    PASSES: Dict[str, Type[VmPass]] = {}
+
+    def __init__(self, enabled: Optional[Iterable[str]] = None, options: Optional[Dict[str, dict]] = None):
+        names = list(enabled or [])
+        options = options or {}
+        for name in names:
+            if name not in self.PASSES:
+                raise Exception(f"unknown vm pass {name}")
+        # 按给出的顺序执行, 同一个pass可以出现多次; options 按pass名给出构造参数
+        self.passes: List[VmPass] = [self.PASSES[name](**options.get(name, {})) for name in names]
+        self.timings: Dict[VmPass, float] = {}
+
+    @classmethod
+    def register(cls, pass_class: Type[VmPass]) -> Type[VmPass]:
+        cls.PASSES[pass_class.name] = pass_class
+        return pass_class
+
+    def run(self, program: VmProgram, measure: Optional[Callable[[List[VmFunction]], int]] = None):
+        for vm_pass in self.passes:
+            vm_pass.measure = measure
+            start = time.perf_counter()
+            vm_pass.run(program)
+            self.timings[vm_pass] = time.perf_counter() - start
+
+    def report(self, show_time: bool = False) -> str:
+        lines = []
+        for vm_pass in self.passes:
+            timing = f"{self.timings.get(vm_pass, 0) * 1000:>8.2f} ms  " if show_time else ""
+            lines.append(f"{vm_pass.name:<20}{timing}{vm_pass.report()}")
+        return "\n".join(lines)
+
+
+@PassManager.register
+class GotoNextPass(VmPass):
+    name = "goto-next"
+    description = "drop a goto whose target label follows immediately"
+
+    def run_function(self, function: VmFunction):
+        commands = function.commands
+        kept = []
+        for index, command in enumerate(commands):
+            if command.command_type == CommandType.C_GOTO and index + 1 < len(commands):
+                following = commands[index + 1]
+                if following.command_type == CommandType.C_LABEL and following.arg1 == command.arg1:
+                    self.changed += 1
+                    continue
+            kept.append(command)
+        function.commands = kept
+
+
+@PassManager.register
+class UnusedLabelPass(VmPass):
+    name = "unused-labels"
+    description = "drop labels no jump in the function refers to (fewer block boundaries)"
+
+    def run_function(self, function: VmFunction):
+        targets = {command.jump_label() for command in function.commands}
+        kept = []
+        for command in function.commands:
+            if command.command_type == CommandType.C_LABEL and command.arg1 not in targets:
+                self.changed += 1
+                continue
+            kept.append(command)
+        function.commands = kept
+
+
+@PassManager.register
+class DeadFunctionPass(VmPass):
+    name = "dead-functions"
+    description = "drop functions not reachable through calls from Sys.init"
+    ENTRY = "Sys.init"
+    CALLS = (CommandType.C_CALL, CommandType.C_TAILCALL)
+
+    def __init__(self):
+        super().__init__()
+        self.dropped: List[VmFunction] = []
+        self.words_saved = 0
+        self.skipped = False
+
+    def run(self, program: VmProgram):
+        functions = {function.name: function for function in program.functions() if function.name is not None}
+        if self.ENTRY not in functions:
+            # 没有入口(单个测试文件等)时无法确定调用关系
+            self.skipped = True
+            return
+        # 文件开头不属于任何函数的命令总会执行, 它们调用的函数也是根
+        roots = [self.ENTRY] + [command.arg1 for function in program.functions() if function.name is None
+                                for command in function.commands if command.command_type in self.CALLS]
+        reachable = set()
+        worklist = roots
+        while worklist:
+            name = worklist.pop()
+            if name in reachable or name not in functions:
+                continue
+            reachable.add(name)
+            worklist += [command.arg1 for command in functions[name].commands
+                         if command.command_type in self.CALLS]
+
+        for vm_file in program.files:
+            kept = []
+            for function in vm_file.functions:
+                if function.name is None or function.name in reachable:
+                    kept.append(function)
+                else:
+                    self.dropped.append(function)
+            vm_file.functions = kept
+        self.changed = sum(len(function.commands) for function in self.dropped)
+        if self.measure:
+            self.words_saved = self.measure(self.dropped)
+
+    def report(self) -> str:
+        if self.skipped:
+            return f"skipped, no {self.ENTRY}"
+        lines = [f"{len(self.dropped)} functions dropped, {self.changed} commands, {self.words_saved} words saved"]
+        lines += [f"  {function.name}" for function in self.dropped]
+        return "\n".join(lines)
+
+
+@PassManager.register
+class InlinePass(VmPass):
+    """
+        把小的叶子函数(函数体内没有call)在调用处展开, 省掉call/return保存和恢复栈帧的开销.
+        参数和局部变量映射到inline段(全局变量 $inline.i): 叶子函数执行期间不会进入其他函数,
+        所有展开位置可以共用同一组变量. 被调函数修改 pointer 0/1 时先保存 THIS/THAT, 在return处恢复.
+        标签加上展开位置的后缀(位置编号记在VmProgram上, pass执行多次也不重复), return变为跳到结束标签,
+        返回值正好留在调用者的栈顶.
+        应在superinstructions之前执行, 融合后的函数不会被展开.
+    """
+    name = "inline"
+    description = "inline calls to small leaf functions (no call/return frame)"
+    DEFAULT_THRESHOLD = 12
+
+    def __init__(self, threshold: int = DEFAULT_THRESHOLD):
+        super().__init__()
+        self.threshold = threshold  # 函数体(不含function命令)最多的命令数
+        self.inlined: Counter = Counter()
+        self.words_delta = 0
+
+    @staticmethod
+    def stack_effect(command: VmCommand) -> int:
+        if command.command_type == CommandType.C_PUSH:
+            return 1
+        if command.command_type in (CommandType.C_POP, CommandType.C_IF):
+            return -1
+        if command.command_type == CommandType.C_ARITHMETIC:
+            return 0 if command.arg1 in (ArithmeticType.A_NEG, ArithmeticType.A_NOT) else -1
+        return 0
+
+    @classmethod
+    def balanced(cls, body: List[VmCommand]) -> bool:
+        """ 每个return处栈上只有返回值, 同一标签各个入口的栈深度一致, 且不会执行到函数末尾之后"""
+        label_depths: Dict[str, int] = {}
+        depth: Optional[int] = 0  # None 表示当前位置不可达
+        for command in body:
+            command_type = command.command_type
+            if command_type == CommandType.C_LABEL:
+                known = label_depths.setdefault(command.arg1, depth)
+                if known is None or (depth is not None and depth != known):
+                    return False
+                depth = known
+                continue
+            if depth is None:
+                continue
+            depth += cls.stack_effect(command)
+            if depth < 0:
+                return False
+            if command_type in (CommandType.C_GOTO, CommandType.C_IF):
+                if label_depths.setdefault(command.arg1, depth) != depth:
+                    return False
+            if command_type == CommandType.C_RETURN and depth != 1:
+                return False
+            if command_type in (CommandType.C_GOTO, CommandType.C_RETURN):
+                depth = None
+        return depth is None
+
+    def inlinable(self, function: VmFunction) -> bool:
+        body = function.commands[1:]
+        if function.name is None or len(body) > self.threshold:
+            return False
+        if any(command.parts or command.command_type in (CommandType.C_CALL, CommandType.C_FUNCTION)
+               for command in body):
+            return False
+        # 已经展开过其他函数的函数体使用同一组inline变量, 再展开会互相覆盖
+        if self.segment_indexes(body, SegmentType.S_INLINE):
+            return False
+        return self.balanced(body)
+
+    def expand(self, callee: VmFunction, num_args: int, site: int) -> List[VmCommand]:
+        """ 生成一个展开位置的命令: 参数出栈到inline段, 局部变量清零, 然后是改写后的函数体"""
+        body = callee.commands[1:]
+        locals_base = num_args
+        saved_pointers = sorted({command.arg2 for command in body
+                                 if command.command_type == CommandType.C_POP and command.arg1 == SegmentType.S_POINTER})
+        saved_base = locals_base + callee.num_locals
+        suffix = f"$inline{site}"
+        end_label = f"{callee.name}$end{suffix}"
+
+        output = [VmCommand(CommandType.C_POP, SegmentType.S_INLINE, index) for index in reversed(range(num_args))]
+        for index in range(callee.num_locals):
+            output += [VmCommand(CommandType.C_PUSH, SegmentType.S_CONSTANT, 0),
+                       VmCommand(CommandType.C_POP, SegmentType.S_INLINE, locals_base + index)]
+        for offset, pointer in enumerate(saved_pointers):
+            output += [VmCommand(CommandType.C_PUSH, SegmentType.S_POINTER, pointer),
+                       VmCommand(CommandType.C_POP, SegmentType.S_INLINE, saved_base + offset)]
+
+        for position, command in enumerate(body):
+            command_type = command.command_type
+            if command_type in (CommandType.C_PUSH, CommandType.C_POP) and command.arg1 == SegmentType.S_ARGUMENT:
+                output.append(VmCommand(command_type, SegmentType.S_INLINE, command.arg2))
+            elif command_type in (CommandType.C_PUSH, CommandType.C_POP) and command.arg1 == SegmentType.S_LOCAL:
+                output.append(VmCommand(command_type, SegmentType.S_INLINE, locals_base + command.arg2))
+            elif command_type in (CommandType.C_LABEL, CommandType.C_GOTO, CommandType.C_IF):
+                output.append(VmCommand(command_type, f"{command.arg1}{suffix}"))
+            elif command_type == CommandType.C_RETURN:
+                # 返回值在栈顶, 恢复 THIS/THAT 不影响它
+                for offset, pointer in enumerate(saved_pointers):
+                    output += [VmCommand(CommandType.C_PUSH, SegmentType.S_INLINE, saved_base + offset),
+                               VmCommand(CommandType.C_POP, SegmentType.S_POINTER, pointer)]
+                if position != len(body) - 1:
+                    output.append(VmCommand(CommandType.C_GOTO, end_label))
+            else:
+                output.append(command)
+        if any(command.command_type == CommandType.C_RETURN for command in body[:-1]):
+            output.append(VmCommand(CommandType.C_LABEL, end_label))
+        return output
+
+    @staticmethod
+    def segment_indexes(body: List[VmCommand], segment: SegmentType) -> List[int]:
+        return [command.arg2 for command in body
+                if command.command_type in (CommandType.C_PUSH, CommandType.C_POP) and command.arg1 == segment]
+
+    def run(self, program: VmProgram):
+        # 函数名 -> (函数, 所在文件, 是否使用static, 用到的参数个数)
+        # static段按文件命名, 使用static的函数只能在同一文件内展开
+        candidates = {}
+        for vm_file in program.files:
+            for function in vm_file.functions:
+                if self.inlinable(function):
+                    body = function.commands[1:]
+                    candidates[function.name] = (function, vm_file.filename,
+                                                 bool(self.segment_indexes(body, SegmentType.S_STATIC)),
+                                                 max(self.segment_indexes(body, SegmentType.S_ARGUMENT), default=-1) + 1)
+        if not candidates:
+            return
+        words_before = self.measure(program.functions()) if self.measure else 0
+        for vm_file in program.files:
+            for function in vm_file.functions:
+                output = []
+                for command in function.commands:
+                    if command.command_type == CommandType.C_CALL and command.arg1 in candidates:
+                        callee, filename, uses_static, used_args = candidates[command.arg1]
+                        if (filename == vm_file.filename or not uses_static) and used_args <= command.arg2:
+                            output += self.expand(callee, command.arg2, program.inline_sites)
+                            program.inline_sites += 1
+                            self.changed += 1
+                            self.inlined[callee.name] += 1
+                            continue
+                    output.append(command)
+                function.commands = output
+        if self.measure:
+            self.words_delta = self.measure(program.functions()) - words_before
+
+    def report(self) -> str:
+        lines = [f"{self.changed} call sites inlined, {len(self.inlined)} functions, {self.words_delta:+} words"]
+        lines += [f"  {name:<32}{count:>6} sites" for name, count in self.inlined.most_common()]
+        return "\n".join(lines)
+
+
+@PassManager.register
+class TailCallPass(VmPass):
+    """
+        call f n 后紧跟 return 时融合为 C_TAILCALL: 新参数和当前帧保存的返回地址/LCL/ARG/THIS/THAT
+        一起移到当前ARG处, 直接跳到f, f返回时回到当前函数的调用者. 递归调用的栈深度不再增长.
+    """
+    name = "tail-calls"
+    description = "turn call+return into a jump that reuses the current frame"
+
+    def __init__(self):
+        super().__init__()
+        self.recursive = 0
+
+    def run_function(self, function: VmFunction):
+        output: List[VmCommand] = []
+        for command in function.commands:
+            if command.command_type == CommandType.C_RETURN and output \
+                    and output[-1].command_type == CommandType.C_CALL:
+                call = output.pop()
+                output.append(VmCommand(CommandType.C_TAILCALL, call.arg1, call.arg2, parts=(call, command)))
+                self.changed += 1
+                self.recursive += call.arg1 == function.name
+                continue
+            output.append(command)
+        function.commands = output
+
+    def report(self) -> str:
+        return f"{self.changed} tail calls, {self.recursive} self-recursive"
+
+
+@PassManager.register
+class ConstantFoldPass(VmPass):
+    """
+        在每条命令加入输出后检查输出尾部, 替换后继续检查, 规则可以级联(push 0 / not / not / if-goto 整体消失).
+        标签不会被任何规则匹配, 所以替换不会跨越基本块.
+        常数按16位有符号数保存, 可能为负, 由CodeWriter负责生成负常数.
+    """
+    name = "constant-fold"
+    description = "fold constant arithmetic/comparisons/logic and drop identities like x+0, not not"
+
+    BINARY_OPERATIONS: Dict[ArithmeticType, Callable[[int, int], int]] = {
+        ArithmeticType.A_ADD: lambda x, y: x + y,
+        ArithmeticType.A_SUB: lambda x, y: x - y,
+        ArithmeticType.A_AND: lambda x, y: x & y,
+        ArithmeticType.A_OR: lambda x, y: x | y,
+        # 与生成的汇编一致: 比较的是16位溢出后的 x-y
+        ArithmeticType.A_EQ: lambda x, y: -1 if ConstantFoldPass.to_signed(x - y) == 0 else 0,
+        ArithmeticType.A_GT: lambda x, y: -1 if ConstantFoldPass.to_signed(x - y) > 0 else 0,
+        ArithmeticType.A_LT: lambda x, y: -1 if ConstantFoldPass.to_signed(x - y) < 0 else 0,
+    }
+    UNARY_OPERATIONS: Dict[ArithmeticType, Callable[[int], int]] = {
+        ArithmeticType.A_NEG: lambda x: -x,
+        ArithmeticType.A_NOT: lambda x: ~x,
+    }
+    # 与常数运算结果不变: x+0, x-0, x|0, x&-1
+    IDENTITIES = {
+        (ArithmeticType.A_ADD, 0),
+        (ArithmeticType.A_SUB, 0),
+        (ArithmeticType.A_OR, 0),
+        (ArithmeticType.A_AND, -1),
+    }
+
+    @staticmethod
+    def to_signed(value: int) -> int:
+        value &= 0xFFFF
+        return value - 0x10000 if value & 0x8000 else value
+
+    @staticmethod
+    def constant(command: VmCommand) -> Optional[int]:
+        if command.command_type == CommandType.C_PUSH and command.arg1 == SegmentType.S_CONSTANT:
+            return command.arg2
+        return None
+
+    @staticmethod
+    def arithmetic(command: VmCommand) -> Optional[ArithmeticType]:
+        return command.arg1 if command.command_type == CommandType.C_ARITHMETIC else None
+
+    def rewrite_tail(self, output: List[VmCommand]) -> bool:
+        last = output[-1]
+        operation = self.arithmetic(last)
+        before = self.constant(output[-2]) if len(output) >= 2 else None
+
+        if operation in self.BINARY_OPERATIONS and before is not None:
+            if (operation, before) in self.IDENTITIES:
+                del output[-2:]
+                return True
+            first = self.constant(output[-3]) if len(output) >= 3 else None
+            if first is not None:
+                value = self.to_signed(self.BINARY_OPERATIONS[operation](first, before))
+                output[-3:] = [VmCommand(CommandType.C_PUSH, SegmentType.S_CONSTANT, value)]
+                return True
+        elif operation in self.UNARY_OPERATIONS:
+            if before is not None:
+                value = self.to_signed(self.UNARY_OPERATIONS[operation](before))
+                output[-2:] = [VmCommand(CommandType.C_PUSH, SegmentType.S_CONSTANT, value)]
+                return True
+            if len(output) >= 2 and self.arithmetic(output[-2]) == operation:
+                # not not / neg neg
+                del output[-2:]
+                return True
+        elif last.command_type == CommandType.C_IF and before is not None:
+            # 条件已知: 恒真变为goto, 恒假整体去掉
+            output[-2:] = [VmCommand(CommandType.C_GOTO, last.arg1)] if before else []
+            return True
+        return False
+
+    def run_function(self, function: VmFunction):
+        output: List[VmCommand] = []
+        for command in function.commands:
+            output.append(command)
+            while output and self.rewrite_tail(output):
+                pass
+        self.changed += len(function.commands) - len(output)
+        function.commands = output
+
+
+@PassManager.register
+class SuperinstructionPass(VmPass):
+    """
+        把编译器输出中最常见的命令序列融合为超级指令, 由CodeWriter直接生成不经过栈的汇编.
+        候选序列来自 IdiomStatistics 在Jack程序上的统计: 局部变量自增, push/pop 搬运,
+        数组读写(pointer 1 + that 0), 比较后立即条件跳转.
+    """
+    name = "superinstructions"
+    description = "fuse frequent command sequences (x=x+c, push/pop moves, array access, compare+branch)"
+
+    COMPARISONS = (ArithmeticType.A_EQ, ArithmeticType.A_GT, ArithmeticType.A_LT)
+
+    def __init__(self):
+        super().__init__()
+        self.hits: Counter = Counter()
+
+    @staticmethod
+    def is_command(command: VmCommand, command_type: CommandType, arg1=None, arg2=None) -> bool:
+        return (command.command_type == command_type and (arg1 is None or command.arg1 == arg1)
+                and (arg2 is None or command.arg2 == arg2))
+
+    def is_store_that(self, window: List[VmCommand]) -> bool:
+        return (len(window) == 4
+                and self.is_command(window[0], CommandType.C_POP, SegmentType.S_TEMP, 0)
+                and self.is_command(window[1], CommandType.C_POP, SegmentType.S_POINTER, 1)
+                and self.is_command(window[2], CommandType.C_PUSH, SegmentType.S_TEMP, 0)
+                and self.is_command(window[3], CommandType.C_POP, SegmentType.S_THAT, 0))
+
+    def match(self, commands: List[VmCommand], start: int) -> Optional[VmCommand]:
+        """ 在start处按从长到短的顺序尝试各个模式, 返回融合后的命令"""
+        window = commands[start:start + 4]
+        first = window[0]
+        if len(window) == 4:
+            push, constant, operation, pop = window
+            if (self.is_command(push, CommandType.C_PUSH) and push.arg1 != SegmentType.S_CONSTANT
+                    and self.is_command(constant, CommandType.C_PUSH, SegmentType.S_CONSTANT)
+                    and operation.command_type == CommandType.C_ARITHMETIC
+                    and operation.arg1 in (ArithmeticType.A_ADD, ArithmeticType.A_SUB)
+                    and self.is_command(pop, CommandType.C_POP, push.arg1, push.arg2)):
+                return VmCommand(CommandType.C_INC, push.arg1, push.arg2, parts=tuple(window))
+            if self.is_store_that(window):
+                return VmCommand(CommandType.C_STORE_THAT, parts=tuple(window))
+        if first.command_type == CommandType.C_ARITHMETIC and first.arg1 in self.COMPARISONS:
+            if len(window) >= 3 and self.is_command(window[1], CommandType.C_ARITHMETIC, ArithmeticType.A_NOT) \
+                    and window[2].command_type == CommandType.C_IF:
+                return VmCommand(CommandType.C_IF_COMPARE, window[2].arg1, parts=tuple(window[:3]))
+            if len(window) >= 2 and window[1].command_type == CommandType.C_IF:
+                return VmCommand(CommandType.C_IF_COMPARE, window[1].arg1, parts=tuple(window[:2]))
+        if len(window) >= 2:
+            second = window[1]
+            if self.is_command(first, CommandType.C_POP, SegmentType.S_POINTER, 1) \
+                    and self.is_command(second, CommandType.C_PUSH, SegmentType.S_THAT, 0):
+                return VmCommand(CommandType.C_DEREF, parts=tuple(window[:2]))
+            # pop temp 0 属于后面的数组写入时留给 C_STORE_THAT
+            if first.command_type == CommandType.C_PUSH and second.command_type == CommandType.C_POP \
+                    and not self.is_store_that(commands[start + 1:start + 5]):
+                return VmCommand(CommandType.C_MOVE, second.arg1, second.arg2, parts=tuple(window[:2]))
+        return None
+
+    def run_function(self, function: VmFunction):
+        commands = function.commands
+        output = []
+        index = 0
+        while index < len(commands):
+            fused = self.match(commands, index)
+            if fused is None:
+                output.append(commands[index])
+                index += 1
+                continue
+            output.append(fused)
+            index += len(fused.parts)
+            self.hits[fused.command_type.name] += 1
+            self.changed += len(fused.parts) - 1
+        function.commands = output
+
+    def report(self) -> str:
+        fused = ", ".join(f"{name} {count}" for name, count in self.hits.most_common())
+        return f"{self.changed} commands removed by fusing ({fused or 'nothing'})"
@@ -1,86 +1,29 @@
 import argparse
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
 from enum import IntEnum
+from itertools import repeat
 from pathlib import Path
-from typing import TextIO, Dict, List, Tuple
+from typing import TextIO, Dict, List, Tuple, Optional, Iterator
 
+from Assembler import Assembler, PeepholeOptimizer, DeadCodeEliminator
 from BaseUtils import BaseParser
+from VmIR import (CommandType, SegmentType, ArithmeticType, Str2SegmentTypeMap, SegmentType2LocalStrMap,
+                  Str2ArithmeticMap, ArithmeticType2OptStr, VmCommand, VmFunction, VmFile, VmProgram)
+from VmOptimizer import PassManager, IdiomStatistics, InlinePass
 
 
-class CommandType(IntEnum):
-    C_ARITHMETIC = 1
-    C_PUSH = 2
-    C_POP = 3
-    C_LABEL = 4
-    C_GOTO = 5
-    C_IF = 6
-    C_FUNCTION = 7
-    C_RETURN = 8
-    C_CALL = 9
-
-
-class SegmentType(IntEnum):
-    S_ARGUMENT = 1      # 函数参数
-    S_LOCAL = 2         # 函数局部变量
-    S_STATIC = 3        # 同一vm文件所有函数共享的静态变量
-    S_CONSTANT = 4      # 所有常数的伪段(0~32767)
-    S_THIS = 5          # 通用段
-    S_THAT = 6          # 通用段
-    S_POINTER = 7       # 保存this/that的段基地址
-    S_TEMP = 8          # 保存临时变量(R5 ~ R12)
-
-
-Str2SegmentTypeMap: Dict[str, SegmentType] = {
-    "argument": SegmentType.S_ARGUMENT,
-    "local": SegmentType.S_LOCAL,
-    "static": SegmentType.S_STATIC,
-    "constant": SegmentType.S_CONSTANT,
-    "this": SegmentType.S_THIS,
-    "that": SegmentType.S_THAT,
-    "pointer": SegmentType.S_POINTER,
-    "temp": SegmentType.S_TEMP
-}
+class OptimizeMode(IntEnum):
+    O_NONE = 0          # 与原来的逐条展开输出一致
+    O_SIZE = 1          # 优先减小ROM: call/return等使用全局共享例程
+    O_SPEED = 2         # 优先减少执行周期
 
 
-SegmentType2LocalStrMap: Dict[SegmentType, str] = {
-    SegmentType.S_LOCAL: "LCL",
-    SegmentType.S_ARGUMENT: "ARG",
-    SegmentType.S_THIS: "THIS",
-    SegmentType.S_THAT: "THAT",
-}
-
-
-class ArithmeticType(IntEnum):
-    A_ADD = 1
-    A_SUB = 2
-    A_NEG = 3
-    A_EQ = 4
-    A_GT = 5
-    A_LT = 6
-    A_AND = 7
-    A_OR = 8
-    A_NOT = 9
-
-
-Str2ArithmeticMap: Dict[str, ArithmeticType] = {
-    "add": ArithmeticType.A_ADD,
-    "sub": ArithmeticType.A_SUB,
-    "neg": ArithmeticType.A_NEG,
-    "eq": ArithmeticType.A_EQ,
-    "gt": ArithmeticType.A_GT,
-    "lt": ArithmeticType.A_LT,
-    "and": ArithmeticType.A_AND,
-    "or": ArithmeticType.A_OR,
-    "not": ArithmeticType.A_NOT
-}
-
-ArithmeticType2OptStr: Dict[ArithmeticType, str] = {
-    ArithmeticType.A_ADD: '+',
-    ArithmeticType.A_SUB: '-',
-    ArithmeticType.A_AND: '&',
-    ArithmeticType.A_OR: '|',
-    ArithmeticType.A_EQ: 'EQ',
-    ArithmeticType.A_GT: 'GT',
-    ArithmeticType.A_LT: 'LT',
+Str2OptimizeModeMap: Dict[str, OptimizeMode] = {
+    "none": OptimizeMode.O_NONE,
+    "size": OptimizeMode.O_SIZE,
+    "speed": OptimizeMode.O_SPEED,
 }
 
 
@@ -121,18 +64,83 @@ class Parser(BaseParser):
         result = self.current_cmd.split()[2]
         return result
 
+    def command(self) -> VmCommand:
+        command_type = self.command_type()
+        if command_type in (CommandType.C_PUSH, CommandType.C_POP):
+            return VmCommand(command_type, Str2SegmentTypeMap[self.arg1()], int(self.arg2()), self.current_cmd)
+        elif command_type == CommandType.C_ARITHMETIC:
+            return VmCommand(command_type, Str2ArithmeticMap[self.current_cmd], text=self.current_cmd)
+        elif command_type in (CommandType.C_FUNCTION, CommandType.C_CALL):
+            return VmCommand(command_type, self.arg1(), int(self.arg2()), self.current_cmd)
+        elif command_type == CommandType.C_RETURN:
+            return VmCommand(command_type, text=self.current_cmd)
+        return VmCommand(command_type, self.arg1(), text=self.current_cmd)
+
+
+# 比较+条件跳转超级指令: (比较类型, 是否取反) -> 对 x-y 的跳转条件
+CompareJumpMap: Dict[Tuple[ArithmeticType, bool], str] = {
+    (ArithmeticType.A_EQ, False): "JEQ",
+    (ArithmeticType.A_EQ, True): "JNE",
+    (ArithmeticType.A_GT, False): "JGT",
+    (ArithmeticType.A_GT, True): "JLE",
+    (ArithmeticType.A_LT, False): "JLT",
+    (ArithmeticType.A_LT, True): "JGE",
+}
+
 
 class CodeWriter:
+    # O_SIZE模式下共享例程的入口标签, $开头不会和vm函数名/标签冲突
+    CALL_ROUTINE = "$CALL"
+    RETURN_ROUTINE = "$RETURN"
+    RUNTIME_END = "$RUNTIME_END"
+    COMPARE_END = "$COMPARE_END"
+    TAILCALL_ROUTINE = "$TAILCALL"
+    TAILCALL_FRAME = "$TAILCALL_FRAME"
+    TAILCALL_LOOP = "$TAILCALL_LOOP"
+    TAILCALL_ARGS_LOOP = "$TAILCALL_ARGS_LOOP"
+    TAILCALL_ARGS_END = "$TAILCALL_ARGS_END"
+    TAILCALL_JUMP = "$TAILCALL_JUMP"
+    # 内联函数的参数/局部变量所在的伪文件名, 所有内联位置共用
+    INLINE_FILENAME = "$inline"
 
-    def __init__(self, asm_file: str):
+    def __init__(self, asm_file: Optional[str] = None, optimize: OptimizeMode = OptimizeMode.O_NONE):
         self.asm_file = asm_file
-        self.asm_obj = open(self.asm_file, "w")
+        self.optimize = optimize
+        # 不指定asm文件时输出到内存, 由drain_lines取走, 整个构建过程不落盘
+        self.asm_obj = open(self.asm_file, "w") if asm_file else io.StringIO()
         self.label_count = 0
         self.return_address_count = 0
+        self.tail_call_count = 0
         self.asm_filename = None
+        self.function_name = None
+        self.top_in_d = False  # O_SPEED: 栈顶元素缓存在D中, 还没有写回栈(SP不含它)
 
     def set_filename(self, filename: str):
+        self.spill()
         self.asm_filename = filename
+        self.function_name = None
+
+    @property
+    def scope(self) -> str:
+        """ 标签的命名空间: 当前函数, 文件开头不属于函数的命令用文件名, bootstrap用 $bootstrap"""
+        return self.function_name or self.asm_filename or "$bootstrap"
+
+    def vm_label(self, label: str) -> str:
+        """ vm标签只在函数内有效, 加上函数名前缀(f$label)后不同函数/文件的同名标签不再冲突"""
+        return f"{self.scope}${label}"
+
+    def generated_label(self, kind: str, index: int) -> str:
+        """
+            翻译器生成的标签(返回地址/比较等), 形如 scope$kind$n.
+            vm标签中的$只来自InlinePass的后缀(X$inline3, f$end$inline3), 结尾不会是单独的 $数字,
+            所以 vm_label 不会和它冲突
+        """
+        return f"{self.scope}${kind}${index}"
+
+    def static_symbol(self, segment: SegmentType, index: int) -> str:
+        """ static段和内联变量都是按名字分配的变量"""
+        filename = self.INLINE_FILENAME if segment == SegmentType.S_INLINE else self.asm_filename
+        return f"{filename}.{index}"
 
     @staticmethod
     def push_value_snippets(value="D") -> str:
@@ -186,7 +194,9 @@ class CodeWriter:
         return "\n".join(commands)
 
     def get_func_call_snippets(self, function_name: str, num_args: int):
-        return_address = f"return_address_{self.return_address_count}"
+        if self.optimize == OptimizeMode.O_SIZE:
+            return self.get_shared_call_snippets(function_name, num_args)
+        return_address = self.generated_label("ret", self.return_address_count)
         commands = [
             # push return-address
             f"@{return_address}",
@@ -230,6 +240,441 @@ class CodeWriter:
         self.return_address_count += 1
         return "\n".join(commands)
 
+    def get_shared_call_snippets(self, function_name: str, num_args: int):
+        """ 调用点只准备 R13=参数个数, R14=目标函数, D=返回地址, 其余交给共享的call例程"""
+        return_address = self.generated_label("ret", self.return_address_count)
+        commands = [
+            f"@{num_args}",
+            "D=A",
+            "@R13",
+            "M=D",
+            f"@{function_name}",
+            "D=A",
+            "@R14",
+            "M=D",
+            f"@{return_address}",
+            "D=A",
+            f"@{self.CALL_ROUTINE}",
+            "0;JMP",
+            f"({return_address})",
+        ]
+        self.return_address_count += 1
+        return "\n".join(commands)
+
+    def call_routine_snippets(self):
+        """ 共享的call例程: 压入D(返回地址)和调用者的LCL/ARG/THIS/THAT, ARG = SP-R13-5, LCL = SP, 跳到R14"""
+        commands = [
+            f"({self.CALL_ROUTINE})",
+            self.push_value_snippets(),
+            "@LCL",
+            "D=M",
+            self.push_value_snippets(),
+            "@ARG",
+            "D=M",
+            self.push_value_snippets(),
+            "@THIS",
+            "D=M",
+            self.push_value_snippets(),
+            "@THAT",
+            "D=M",
+            self.push_value_snippets(),
+            # ARG = SP-n-5
+            "@SP",
+            "D=M",
+            "@R13",
+            "D=D-M",
+            "@5",
+            "D=D-A",
+            "@ARG",
+            "M=D",
+            # LCL = SP
+            "@SP",
+            "D=M",
+            "@LCL",
+            "M=D",
+            # goto f
+            "@R14",
+            "A=M",
+            "0;JMP",
+        ]
+        return "\n".join(commands)
+
+    def frame_push_snippets(self) -> str:
+        """ 把当前帧保存的返回地址和LCL/ARG/THIS/THAT按原来的顺序压栈"""
+        commands = []
+        for offset in range(5, 0, -1):
+            commands += ["@LCL", "D=M", f"@{offset}", "A=D-A", "D=M", self.push_value_snippets()]
+        return "\n".join(commands)
+
+    def get_tail_call_snippets(self, function_name: str, num_args: int) -> str:
+        """
+            尾调用复用当前栈帧. 参数个数与当前函数相同(LCL == ARG+n+5, 如自递归)时帧不用移动,
+            只把新参数复制到ARG处, LCL不变, SP = LCL; 否则由共享的尾调用例程移动帧.
+            O_SIZE模式下只准备 R13=参数个数, R14=目标函数, 两种情况都交给例程.
+        """
+        slow_path = [
+            f"@{num_args}",
+            "D=A",
+            "@R13",
+            "M=D",
+            f"@{function_name}",
+            "D=A",
+            "@R14",
+            "M=D",
+            f"@{self.TAILCALL_ROUTINE}",
+            "0;JMP",
+        ]
+        if self.optimize == OptimizeMode.O_SIZE:
+            return "\n".join(slow_path)
+        slow_label = self.generated_label("tail", self.tail_call_count)
+        self.tail_call_count += 1
+        commands = [
+            "@LCL",
+            "D=M",
+            "@ARG",
+            "D=D-M",
+            f"@{num_args + 5}",
+            "D=D-A",
+            f"@{slow_label}",
+            "D;JNE",
+            # R15 = SP-n-1, R14 = ARG-1, 复制时先加一
+            "@SP",
+            "D=M",
+            f"@{num_args + 1}",
+            "D=D-A",
+            "@R15",
+            "M=D",
+            "@ARG",
+            "D=M-1",
+            "@R14",
+            "M=D",
+        ]
+        for _ in range(num_args):
+            commands += ["@R15", "AM=M+1", "D=M", "@R14", "AM=M+1", "M=D"]
+        commands += [
+            "@LCL",
+            "D=M",
+            "@SP",
+            "M=D",
+            f"@{function_name}",
+            "0;JMP",
+            f"({slow_label})",
+        ] + slow_path
+        return "\n".join(commands)
+
+    @staticmethod
+    def copy_loop_snippets(loop_label: str) -> str:
+        """ 从R15复制R13(>0)个字到LCL指向的地址, 结束时LCL指向最后一个字之后"""
+        commands = [
+            f"({loop_label})",
+            "@R15",
+            "A=M",
+            "D=M",
+            "@LCL",
+            "A=M",
+            "M=D",
+            "@R15",
+            "M=M+1",
+            "@LCL",
+            "M=M+1",
+            "@R13",
+            "MD=M-1",
+            f"@{loop_label}",
+            "D;JGT",
+        ]
+        return "\n".join(commands)
+
+    def tail_call_routine_snippets(self) -> str:
+        """
+            共享的尾调用例程: R13=参数个数, R14=目标函数. 复制时借用LCL作为目标指针, 它最后会被重新设置.
+            帧大小不变时只复制参数, LCL最后加回5;
+            否则保存的帧压在新参数之上, 新参数和帧共 n+5 个字从低到高整体移到ARG处
+            (目标总在源之下, 顺序复制不会覆盖还没读的值), 结束时 LCL = ARG+n+5.
+        """
+        commands = [
+            f"({self.TAILCALL_ROUTINE})",
+            "@ARG",
+            "D=M",
+            "@R13",
+            "D=D+M",
+            "@5",
+            "D=D+A",
+            "@LCL",
+            "D=D-M",
+            f"@{self.TAILCALL_FRAME}",
+            "D;JNE",
+            # 帧大小不变: R15 = SP-n, LCL = ARG
+            "@SP",
+            "D=M",
+            "@R13",
+            "D=D-M",
+            "@R15",
+            "M=D",
+            "@ARG",
+            "D=M",
+            "@LCL",
+            "M=D",
+            "@R13",
+            "D=M",
+            f"@{self.TAILCALL_ARGS_END}",
+            "D;JEQ",
+            self.copy_loop_snippets(self.TAILCALL_ARGS_LOOP),
+            f"({self.TAILCALL_ARGS_END})",
+            "@5",
+            "D=A",
+            "@LCL",
+            "M=D+M",
+            f"@{self.TAILCALL_JUMP}",
+            "0;JMP",
+            # 移动帧: 先把保存的返回地址和LCL/ARG/THIS/THAT压栈
+            f"({self.TAILCALL_FRAME})",
+            self.frame_push_snippets(),
+            # R13 = n+5 个字, R15 = SP-R13, LCL = ARG
+            "@5",
+            "D=A",
+            "@R13",
+            "MD=D+M",
+            "@SP",
+            "D=M-D",
+            "@R15",
+            "M=D",
+            "@ARG",
+            "D=M",
+            "@LCL",
+            "M=D",
+            self.copy_loop_snippets(self.TAILCALL_LOOP),
+            # SP = LCL, 跳到目标函数
+            f"({self.TAILCALL_JUMP})",
+            "@LCL",
+            "D=M",
+            "@SP",
+            "M=D",
+            "@R14",
+            "A=M",
+            "0;JMP",
+        ]
+        return "\n".join(commands)
+
+    def compare_routine_snippets(self):
+        """
+            共享的eq/gt/lt例程: 入口时D为返回地址, 存入R15; 弹出y, 把栈顶x原地替换为 x-y 比较的结果.
+            先写入true, 条件不成立时再改为false, 三个例程共用返回的尾部.
+        """
+        commands = []
+        for command in (ArithmeticType.A_EQ, ArithmeticType.A_GT, ArithmeticType.A_LT):
+            cmd_opt = ArithmeticType2OptStr[command]
+            commands += [
+                f"(${cmd_opt})",
+                "@R15",
+                "M=D",
+                "@SP",
+                "AM=M-1",
+                "D=M",
+                "A=A-1",
+                "D=M-D",
+                "M=-1",
+                f"@{self.COMPARE_END}",
+                f"D;J{cmd_opt}",
+                "@SP",
+                "A=M-1",
+                "M=0",
+                f"@{self.COMPARE_END}",
+                "0;JMP",
+            ]
+        commands += [
+            f"({self.COMPARE_END})",
+            "@R15",
+            "A=M",
+            "0;JMP",
+        ]
+        return "\n".join(commands)
+
+    def write_runtime(self, skip: bool, tail_calls: bool = False):
+        """
+            在程序开头输出一次共享例程: O_SIZE模式下的call/return/比较, 以及有尾调用时的尾调用例程.
+            有bootstrap时紧跟在调用Sys.init之后(Sys.init不会返回), 否则先跳过例程.
+        """
+        asm_commands = []
+        if self.optimize == OptimizeMode.O_SIZE:
+            asm_commands += [
+                f"({self.RETURN_ROUTINE})",
+                self.get_return_snippets(frame="R13", ret="R14"),
+                self.call_routine_snippets(),
+                self.compare_routine_snippets(),
+            ]
+        if tail_calls:
+            asm_commands.append(self.tail_call_routine_snippets())
+        if not asm_commands:
+            return
+        if skip:
+            asm_commands = [f"@{self.RUNTIME_END}", "0;JMP"] + asm_commands + [f"({self.RUNTIME_END})"]
+        self.write_commands(asm_commands)
+
+    def spill(self):
+        """ 把缓存在D中的栈顶写回栈, 在标签/跳转/调用/返回等基本块边界之前调用"""
+        if self.top_in_d:
+            self.top_in_d = False
+            self.write_commands([self.push_value_snippets()])
+
+    def top_to_d_snippets(self) -> str:
+        """ 保证栈顶在D中: 已缓存时什么都不做, 否则出栈到D"""
+        if self.top_in_d:
+            return "// top of stack already in D"
+        return "\n".join(["// pop the top element into D", "@SP", "AM=M-1", "D=M"])
+
+    @staticmethod
+    def load_constant_snippets(value: int) -> str:
+        """ D = value, 优化pass折叠出的常数可能为负数(16位有符号)"""
+        if value >= 0:
+            commands = [f"@{value}", "D=A"]
+        elif value == -1:
+            commands = ["D=-1"]
+        elif value > -32768:
+            commands = [f"@{-value}", "D=-A"]
+        else:
+            commands = ["@32767", "D=-A", "D=D-1"]
+        return "\n".join(commands)
+
+    def load_segment_snippets(self, segment: SegmentType, index: int) -> str:
+        """ D = segment[index], 只使用A和D"""
+        if segment == SegmentType.S_CONSTANT:
+            commands = [self.load_constant_snippets(index)]
+        elif segment in (SegmentType.S_STATIC, SegmentType.S_INLINE):
+            commands = [f"@{self.static_symbol(segment, index)}", "D=M"]
+        elif segment == SegmentType.S_TEMP:
+            commands = [f"@R{5 + index}", "D=M"]
+        elif segment == SegmentType.S_POINTER:
+            commands = [f"@R{3 + index}", "D=M"]
+        elif index == 0:
+            commands = [f"@{SegmentType2LocalStrMap[segment]}", "A=M", "D=M"]
+        else:
+            commands = [f"@{SegmentType2LocalStrMap[segment]}", "D=M", f"@{index}", "A=D+A", "D=M"]
+        return "\n".join(commands)
+
+    def store_segment_snippets(self, segment: SegmentType, index: int) -> str:
+        """ segment[index] = D, 偏移较大时借用R13/R14保存地址和值"""
+        if segment in (SegmentType.S_STATIC, SegmentType.S_INLINE):
+            commands = [f"@{self.static_symbol(segment, index)}", "M=D"]
+        elif segment == SegmentType.S_TEMP:
+            commands = [f"@R{5 + index}", "M=D"]
+        elif segment == SegmentType.S_POINTER:
+            commands = [f"@R{3 + index}", "M=D"]
+        elif index <= 3:
+            commands = [f"@{SegmentType2LocalStrMap[segment]}", "A=M"] + ["A=A+1"] * index + ["M=D"]
+        else:
+            commands = [
+                self.store_result_by_r14(),
+                f"@{SegmentType2LocalStrMap[segment]}",
+                "D=M",
+                f"@{index}",
+                "D=D+A",
+                self.store_result_by_r13(),
+                "@R14",
+                "D=M",
+                self.store_top_value_by_r13(),
+            ]
+        return "\n".join(commands)
+
+    def segment_address_snippets(self, segment: SegmentType, index: int, keep_d: bool) -> Optional[str]:
+        """ A = segment[index]的地址; keep_d 时不能使用D, 偏移太大无法做到时返回None"""
+        if segment in (SegmentType.S_STATIC, SegmentType.S_INLINE):
+            commands = [f"@{self.static_symbol(segment, index)}"]
+        elif segment == SegmentType.S_TEMP:
+            commands = [f"@R{5 + index}"]
+        elif segment == SegmentType.S_POINTER:
+            commands = [f"@R{3 + index}"]
+        elif index <= (3 if keep_d else 2):
+            commands = [f"@{SegmentType2LocalStrMap[segment]}", "A=M"] + ["A=A+1"] * index
+        elif keep_d:
+            return None
+        else:
+            commands = [f"@{SegmentType2LocalStrMap[segment]}", "D=M", f"@{index}", "A=D+A"]
+        return "\n".join(commands)
+
+    def write_move(self, source_segment: SegmentType, source_index: int, segment: SegmentType, index: int):
+        """ push X / pop Y: 经D直接搬运, 不经过栈"""
+        self.spill()
+        self.write_commands([
+            self.load_segment_snippets(source_segment, source_index),
+            self.store_segment_snippets(segment, index),
+        ])
+
+    def write_inc(self, segment: SegmentType, index: int, delta: int):
+        """ X = X + delta, 直接在内存上修改"""
+        self.spill()
+        if delta == 0:
+            return
+        if delta in (1, -1):
+            asm_commands = [
+                self.segment_address_snippets(segment, index, keep_d=False),
+                "M=M+1" if delta == 1 else "M=M-1",
+            ]
+        elif address := self.segment_address_snippets(segment, index, keep_d=True):
+            asm_commands = [
+                self.load_constant_snippets(delta),
+                address,
+                "M=D+M",
+            ]
+        else:
+            asm_commands = [
+                self.segment_address_snippets(segment, index, keep_d=False),
+                "D=A",
+                self.store_result_by_r13(),
+                self.load_constant_snippets(delta),
+                "@R13",
+                "A=M",
+                "M=D+M",
+            ]
+        self.write_commands(asm_commands)
+
+    def write_deref(self):
+        """ pop pointer 1 / push that 0: 栈顶地址替换为该地址上的值, 同时设置THAT"""
+        asm_commands = [
+            self.top_to_d_snippets(),
+            "@THAT",
+            "M=D",
+            "A=D",
+            "D=M",
+        ]
+        if self.optimize == OptimizeMode.O_SPEED:
+            self.top_in_d = True
+        else:
+            asm_commands.append(self.push_value_snippets())
+        self.write_commands(asm_commands)
+
+    def write_store_that(self):
+        """ pop temp 0 / pop pointer 1 / push temp 0 / pop that 0: 栈顶的值写入其下的地址"""
+        asm_commands = [
+            self.top_to_d_snippets(),
+            "@R5",
+            "M=D",
+            "@SP",
+            "AM=M-1",
+            "D=M",
+            "@THAT",
+            "M=D",
+            "@R5",
+            "D=M",
+            "@THAT",
+            "A=M",
+            "M=D",
+        ]
+        self.top_in_d = False
+        self.write_commands(asm_commands)
+
+    def write_if_compare(self, label: str, command: ArithmeticType, negated: bool):
+        """ 比较后立即条件跳转: 不生成true/false值, 直接按 x-y 跳转"""
+        asm_commands = [
+            self.top_to_d_snippets(),
+            "@SP",
+            "AM=M-1",
+            "D=M-D",
+            f"@{self.vm_label(label)}",
+            f"D;{CompareJumpMap[(command, negated)]}",
+        ]
+        self.top_in_d = False
+        self.write_commands(asm_commands)
+
     def write_commands(self, asm_commands: List[str]):
         write_commands = "\n".join(asm_commands) + "\n"
         self.asm_obj.write(write_commands)
@@ -245,41 +690,66 @@ class CodeWriter:
         self.write_commands(asm_commands)
 
     def write_label(self, label: str):
+        self.spill()
         asm_commands = [
-            f"({label})",
+            f"({self.vm_label(label)})",
         ]
         self.write_commands(asm_commands)
 
     def write_goto(self, label: str):
+        self.spill()
         asm_commands = [
-            f"@{label}",
+            f"@{self.vm_label(label)}",
             "0;JMP",
         ]
         self.write_commands(asm_commands)
 
     def write_if(self, label: str):
+        if self.optimize == OptimizeMode.O_SPEED:
+            top_value_snippets = self.top_to_d_snippets()
+            self.top_in_d = False
+        else:
+            top_value_snippets = self.get_top_value_snippets()
         asm_commands = [
-            self.get_top_value_snippets(),
-            f"@{label}",
+            top_value_snippets,
+            f"@{self.vm_label(label)}",
             "D;JNE",
         ]
         self.write_commands(asm_commands)
 
     def write_call(self, function_name: str, num_args: int):
+        self.spill()
         self.asm_obj.write(self.get_func_call_snippets(function_name, num_args) + "\n")
 
+    def write_tail_call(self, function_name: str, num_args: int):
+        self.spill()
+        self.write_commands([self.get_tail_call_snippets(function_name, num_args)])
+
     def write_return(self):
-        asm_commands = [
+        self.spill()
+        if self.optimize == OptimizeMode.O_SIZE:
+            asm_commands = [
+                f"@{self.RETURN_ROUTINE}",
+                "0;JMP",
+            ]
+        else:
+            asm_commands = [
+                self.get_return_snippets(),
+            ]
+        self.write_commands(asm_commands)
+
+    def get_return_snippets(self, frame: str = "FRAME", ret: str = "RET"):
+        commands = [
             # Frame = LCL
             "@LCL",
             "D=M",
-            "@FRAME",
+            f"@{frame}",
             "M=D",
             # RET = *(FRAME - 5)
             "@5",
             "A=D-A",
             "D=M",
-            "@RET",
+            f"@{ret}",
             "M=D",
             # *ARG = pop()
             self.get_top_value_snippets(),
@@ -292,13 +762,13 @@ class CodeWriter:
             "@SP",
             "M=D",
             # THAT = *(FRAME-1)
-            "@FRAME",
+            f"@{frame}",
             "A=M-1",
             "D=M",
             "@THAT",
             "M=D",
             # THIS = *(FRAME-2)
-            "@FRAME",
+            f"@{frame}",
             "D=M",
             "@2",
             "A=D-A",
@@ -306,7 +776,7 @@ class CodeWriter:
             "@THIS",
             "M=D",
             # ARG = *(FRAME-3)
-            "@FRAME",
+            f"@{frame}",
             "D=M",
             "@3",
             "A=D-A",
@@ -314,7 +784,7 @@ class CodeWriter:
             "@ARG",
             "M=D",
             # LCL = *(FRAME=4)
-            "@FRAME",
+            f"@{frame}",
             "D=M",
             "@4",
             "A=D-A",
@@ -322,20 +792,59 @@ class CodeWriter:
             "@LCL",
             "M=D",
             # goto RET
-            "@RET",
+            f"@{ret}",
             "A=M",
             "0;JMP",
 
         ]
-        self.write_commands(asm_commands)
+        return "\n".join(commands)
 
     def write_function(self, function_name: str, num_locals: int):
+        self.spill()
+        self.function_name = function_name
         asm_commands = [
             f"({function_name})",
         ] + [self.push_value_snippets("0") for _ in range(num_locals)]
         self.write_commands(asm_commands)
 
+    def write_arithmetic_cached(self, command: ArithmeticType):
+        """ O_SPEED: 第二个操作数(或唯一操作数)在D中, 结果留在D中不入栈"""
+        asm_commands = [self.top_to_d_snippets()]
+        if command in (ArithmeticType.A_ADD, ArithmeticType.A_SUB, ArithmeticType.A_AND, ArithmeticType.A_OR):
+            asm_commands += [
+                "@SP",
+                "AM=M-1",
+                "D=M-D" if command == ArithmeticType.A_SUB else f"D=D{ArithmeticType2OptStr[command]}M",
+            ]
+        elif command in (ArithmeticType.A_EQ, ArithmeticType.A_GT, ArithmeticType.A_LT):
+            cmd_opt = ArithmeticType2OptStr[command]
+            true_label = self.generated_label(cmd_opt, self.label_count)
+            end_label = self.generated_label("END" + cmd_opt, self.label_count)
+            asm_commands += [
+                "@SP",
+                "AM=M-1",
+                "D=M-D",
+                f"@{true_label}",
+                f"D;J{cmd_opt}",
+                "D=0",
+                f"@{end_label}",
+                "0;JMP",
+                f"({true_label})",
+                "D=-1",
+                f"({end_label})",
+            ]
+            self.label_count += 1
+        elif command == ArithmeticType.A_NEG:
+            asm_commands.append("D=-D")
+        elif command == ArithmeticType.A_NOT:
+            asm_commands.append("D=!D")
+        self.top_in_d = True
+        self.write_commands(asm_commands)
+
     def write_arithmetic(self, command: ArithmeticType):
+        if self.optimize == OptimizeMode.O_SPEED:
+            self.write_arithmetic_cached(command)
+            return
         asm_commands = []
 
         if command in (ArithmeticType.A_ADD, ArithmeticType.A_SUB, ArithmeticType.A_AND, ArithmeticType.A_OR):
@@ -351,8 +860,22 @@ class CodeWriter:
                 f"D=D{cmd_opt}M",
                 self.push_value_snippets(),
             ]
+        elif command in (ArithmeticType.A_EQ, ArithmeticType.A_GT, ArithmeticType.A_LT) and self.optimize == OptimizeMode.O_SIZE:
+            # 跳到共享的比较例程, 返回地址经D传入
+            cmd_opt = ArithmeticType2OptStr[command]
+            true_label = self.generated_label(cmd_opt, self.label_count)
+            asm_commands = [
+                f"@{true_label}",
+                "D=A",
+                f"@${cmd_opt}",
+                "0;JMP",
+                f"({true_label})",
+            ]
+            self.label_count += 1
         elif command in (ArithmeticType.A_EQ, ArithmeticType.A_GT, ArithmeticType.A_LT):
             cmd_opt = ArithmeticType2OptStr[command]
+            true_label = self.generated_label(cmd_opt, self.label_count)
+            end_label = self.generated_label("END" + cmd_opt, self.label_count)
             asm_commands = [
                 self.get_top_value_snippets(),
                 self.store_result_by_r14(),
@@ -362,14 +885,14 @@ class CodeWriter:
                 "D=M",
                 "@R14",
                 "D=D-M",
-                f"@{cmd_opt}{self.label_count}",
+                f"@{true_label}",
                 f"D;J{cmd_opt}",
                 self.push_value_snippets(value="0"),
-                f"@END{cmd_opt}{self.label_count}",
+                f"@{end_label}",
                 "0;JMP",
-                f"({cmd_opt}{self.label_count})",
+                f"({true_label})",
                 self.push_value_snippets(value="-1"),
-                f"(END{cmd_opt}{self.label_count})",
+                f"({end_label})",
             ]
             self.label_count += 1
         elif command == ArithmeticType.A_NEG:
@@ -388,13 +911,25 @@ class CodeWriter:
 
         self.write_commands(asm_commands)
 
+    def write_push_pop_cached(self, command_type: CommandType, segment: SegmentType, index: int):
+        """ O_SPEED: push先把旧的栈顶写回再把新值读入D, pop直接把D存入目标"""
+        if command_type == CommandType.C_PUSH:
+            self.spill()
+            self.write_commands([self.load_segment_snippets(segment, index)])
+            self.top_in_d = True
+        else:
+            self.write_commands([self.top_to_d_snippets(), self.store_segment_snippets(segment, index)])
+            self.top_in_d = False
+
     def write_push_pop(self, command_type: CommandType, segment: SegmentType, index: int):
+        if self.optimize == OptimizeMode.O_SPEED:
+            self.write_push_pop_cached(command_type, segment, index)
+            return
         asm_commands = []
         if command_type == CommandType.C_PUSH:
             if segment == SegmentType.S_CONSTANT:
                 asm_commands = [
-                    f"@{index}",
-                    "D=A",
+                    self.load_constant_snippets(index),
                     self.push_value_snippets(),
                 ]
             elif segment in (SegmentType.S_TEMP, SegmentType.S_LOCAL, SegmentType.S_ARGUMENT, SegmentType.S_THIS, SegmentType.S_THAT):
@@ -421,9 +956,9 @@ class CodeWriter:
                     "D=M",
                     self.push_value_snippets(),
                 ]
-            elif segment == SegmentType.S_STATIC:
+            elif segment in (SegmentType.S_STATIC, SegmentType.S_INLINE):
                 asm_commands = [
-                    f"@{self.asm_filename}.{index}",
+                    f"@{self.static_symbol(segment, index)}",
                     "D=M",
                     self.push_value_snippets(),
                 ]
@@ -454,15 +989,21 @@ class CodeWriter:
                     self.get_top_value_snippets(),
                     self.store_top_value_by_r13(),
                 ]
-            elif segment == SegmentType.S_STATIC:
+            elif segment in (SegmentType.S_STATIC, SegmentType.S_INLINE):
                 asm_commands = [
                     self.get_top_value_snippets(),
-                    f"@{self.asm_filename}.{index}",
+                    f"@{self.static_symbol(segment, index)}",
                     "M=D",
                 ]
 
         self.write_commands(asm_commands)
 
+    def drain_lines(self) -> List[str]:
+        lines = self.asm_obj.getvalue().splitlines()
+        self.asm_obj.seek(0)
+        self.asm_obj.truncate()
+        return lines
+
     def close(self):
         self.asm_obj.close()
 
@@ -475,56 +1016,196 @@ class Vmtranslator:
         if vm_path.is_file():
             return str(Path(vm_file_or_dir).with_suffix('.asm')), [Path(vm_file_or_dir)]
         elif vm_path.is_dir():
-            vm_files = list(vm_path.glob("*.vm"))
+            # 按文件名排序, 输出不依赖文件系统的遍历顺序
+            vm_files = sorted(vm_path.glob("*.vm"))
             asm_file_name = str(vm_path.with_suffix('.asm'))
             return asm_file_name, vm_files
 
-    def __init__(self, vm_file_or_dir: str, bootstrap=True):
+    def __init__(self, vm_file_or_dir: str, bootstrap=True, optimize=OptimizeMode.O_NONE,
+                 pass_manager: Optional[PassManager] = None, idiom_statistics: Optional[IdiomStatistics] = None,
+                 jobs: int = 1):
         self.bootstrap = bootstrap
+        self.pass_manager = pass_manager
+        self.idiom_statistics = idiom_statistics
+        self.jobs = jobs or os.cpu_count() or 1
         self.asm_file, self.vm_files = self.handler_vm_file_or_dir(vm_file_or_dir)
-        self.code_writer = CodeWriter(self.asm_file)
-        self.parser = None
+        # 只负责bootstrap和共享例程, 各文件由 lower_file 用自己的CodeWriter翻译
+        self.code_writer = CodeWriter(None, optimize)
 
     def translator(self):
-        if self.bootstrap:
-            self.code_writer.write_init()
-
-        for vm_file in self.vm_files:
-            vm_file_object = open(vm_file)
-            self.parser = Parser(vm_file_object)
-            self.code_writer.set_filename(vm_file.stem)
-
-            while self.parser.has_more_commands():
-                self.parser.advance()
-                self.code_writer.asm_obj.write(f"// vm command:{self.parser.current_cmd}\n")
-                command_type = self.parser.command_type()
-                if command_type in (CommandType.C_PUSH, CommandType.C_POP):
-                    segment = Str2SegmentTypeMap[self.parser.arg1()]
-                    index = int(self.parser.arg2())
-                    self.code_writer.write_push_pop(command_type, segment, index)
-                elif command_type == CommandType.C_ARITHMETIC:
-                    command = Str2ArithmeticMap[self.parser.current_cmd]
-                    self.code_writer.write_arithmetic(command)
-                elif command_type == CommandType.C_LABEL:
-                    self.code_writer.write_label(self.parser.arg1())
-                elif command_type == CommandType.C_GOTO:
-                    self.code_writer.write_goto(self.parser.arg1())
-                elif command_type == CommandType.C_IF:
-                    self.code_writer.write_if(self.parser.arg1())
-                elif command_type == CommandType.C_RETURN:
-                    self.code_writer.write_return()
-                elif command_type == CommandType.C_FUNCTION:
-                    self.code_writer.write_function(self.parser.arg1(), int(self.parser.arg2()))
-                elif command_type == CommandType.C_CALL:
-                    self.code_writer.write_call(self.parser.arg1(), int(self.parser.arg2()))
-                self.code_writer.asm_obj.write("\n")
-            vm_file_object.close()
+        with open(self.asm_file, "w") as asm_object:
+            for lines in self.translate_files():
+                if lines:
+                    asm_object.write("\n".join(lines) + "\n")
+        self.code_writer.close()
+
+    def translate_lines(self) -> Iterator[str]:
+        """ 逐个文件产出asm行, 不写asm文件"""
+        for lines in self.translate_files():
+            yield from lines
         self.code_writer.close()
 
+    def assemble(self, **assembler_options):
+        """ vm直接生成hack, 不写中间的asm文件, 参数透传给Assembler"""
+        Assembler(self.asm_file, **assembler_options).assemble_stream(self.translate_lines())
+
+    def measure_words(self, functions: List[VmFunction]) -> int:
+        """ 用独立的CodeWriter翻译这些函数, 统计生成的指令数(不含标签和注释)"""
+        code_writer = CodeWriter(None, self.code_writer.optimize)
+        code_writer.set_filename("$measure")
+        for function in functions:
+            for command in function.commands:
+                self.write_command(command, code_writer)
+        code_writer.spill()
+        lines = code_writer.drain_lines()
+        code_writer.close()
+        return sum(1 for line in lines if line and not line.startswith(("//", "(")))
+
+    @staticmethod
+    def load_file(vm_file: Path) -> VmFile:
+        """ 解析一个vm文件为IR, 按函数分组"""
+        vm_ir_file = VmFile(vm_file.stem)
+        function = VmFunction(None)
+        with open(vm_file) as vm_file_object:
+            parser = Parser(vm_file_object)
+            while parser.has_more_commands():
+                parser.advance()
+                command = parser.command()
+                if command.command_type == CommandType.C_FUNCTION:
+                    if function.commands:
+                        vm_ir_file.functions.append(function)
+                    function = VmFunction(command.arg1, command.arg2)
+                function.commands.append(command)
+        if function.commands:
+            vm_ir_file.functions.append(function)
+        return vm_ir_file
+
+    def load_program(self, executor: Optional[ProcessPoolExecutor] = None) -> VmProgram:
+        """ 解析所有vm文件为IR, 给出executor时各文件并行解析"""
+        program = VmProgram()
+        program.files = list((executor.map if executor else map)(self.load_file, self.vm_files))
+        return program
+
+    @staticmethod
+    def write_command(command: VmCommand, code_writer: CodeWriter):
+        command_type = command.command_type
+        if command_type in (CommandType.C_PUSH, CommandType.C_POP):
+            code_writer.write_push_pop(command_type, command.arg1, command.arg2)
+        elif command_type == CommandType.C_ARITHMETIC:
+            code_writer.write_arithmetic(command.arg1)
+        elif command_type == CommandType.C_LABEL:
+            code_writer.write_label(command.arg1)
+        elif command_type == CommandType.C_GOTO:
+            code_writer.write_goto(command.arg1)
+        elif command_type == CommandType.C_IF:
+            code_writer.write_if(command.arg1)
+        elif command_type == CommandType.C_RETURN:
+            code_writer.write_return()
+        elif command_type == CommandType.C_FUNCTION:
+            code_writer.write_function(command.arg1, command.arg2)
+        elif command_type == CommandType.C_CALL:
+            code_writer.write_call(command.arg1, command.arg2)
+        elif command_type == CommandType.C_MOVE:
+            push = command.parts[0]
+            code_writer.write_move(push.arg1, push.arg2, command.arg1, command.arg2)
+        elif command_type == CommandType.C_INC:
+            _, constant, operation, _ = command.parts
+            delta = constant.arg2 if operation.arg1 == ArithmeticType.A_ADD else -constant.arg2
+            code_writer.write_inc(command.arg1, command.arg2, (delta + 0x8000 & 0xFFFF) - 0x8000)
+        elif command_type == CommandType.C_DEREF:
+            code_writer.write_deref()
+        elif command_type == CommandType.C_STORE_THAT:
+            code_writer.write_store_that()
+        elif command_type == CommandType.C_IF_COMPARE:
+            code_writer.write_if_compare(command.arg1, command.parts[0].arg1, len(command.parts) == 3)
+        elif command_type == CommandType.C_TAILCALL:
+            code_writer.write_tail_call(command.arg1, command.arg2)
+
+    @staticmethod
+    def lower_file(vm_file: VmFile, optimize: OptimizeMode) -> List[str]:
+        """
+            用独立的CodeWriter翻译一个文件. 标签都带函数或文件名前缀, 计数器只在文件内递增,
+            结果只取决于文件本身, 可以在任意进程中翻译后按文件顺序拼接.
+        """
+        code_writer = CodeWriter(None, optimize)
+        code_writer.set_filename(vm_file.filename)
+        for function in vm_file.functions:
+            for command in function.commands:
+                code_writer.asm_obj.write(f"// vm command:{command}\n")
+                Vmtranslator.write_command(command, code_writer)
+                code_writer.asm_obj.write("\n")
+        code_writer.spill()
+        lines = code_writer.drain_lines()
+        code_writer.close()
+        return lines
+
+    def translate_files(self) -> Iterator[List[str]]:
+        """
+            先产出bootstrap和共享例程, 再按文件顺序产出每个文件的asm行.
+            jobs>1 时文件的解析和翻译在进程池中进行, 优化pass仍在整个程序上执行;
+            executor.map 按输入顺序返回, 合并结果与顺序翻译逐字节相同.
+        """
+        executor = ProcessPoolExecutor(self.jobs) if self.jobs > 1 and len(self.vm_files) > 1 else None
+        try:
+            program = self.load_program(executor)
+            if self.idiom_statistics:
+                self.idiom_statistics.collect(program)
+            if self.pass_manager:
+                self.pass_manager.run(program, measure=self.measure_words)
+
+            if self.bootstrap:
+                self.code_writer.write_init()
+            tail_calls = any(command.command_type == CommandType.C_TAILCALL
+                             for function in program.functions() for command in function.commands)
+            self.code_writer.write_runtime(skip=not self.bootstrap, tail_calls=tail_calls)
+            yield self.code_writer.drain_lines()
+
+            optimize = self.code_writer.optimize
+            yield from (executor.map if executor else map)(self.lower_file, program.files, repeat(optimize))
+        finally:
+            if executor:
+                executor.shutdown()
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Vmtranslator")
     parser.add_argument("vm_file_or_dir", type=str, help="vm file or dir path")
     parser.add_argument('--no-bootstrap', '-n', help="don't add bootstrap code", action="store_true")
+    parser.add_argument('--optimize', '-O', choices=list(Str2OptimizeModeMap), default="none",
+                        help="size: share call/return/compare code between call sites; speed: keep the top of stack in D")
+    parser.add_argument('--passes', type=str, help=f"comma separated vm optimization passes: {','.join(PassManager.PASSES)}")
+    parser.add_argument('--inline-threshold', type=int, default=InlinePass.DEFAULT_THRESHOLD, metavar="N",
+                        help="inline pass: inline leaf functions of at most N commands")
+    parser.add_argument('--time-passes', help="also print the time spent in each vm pass", action="store_true")
+    parser.add_argument('--idiom-stats', type=int, metavar="N", help="print the N most frequent command sequences")
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help="translate files in N worker processes (0 = one per CPU)")
+    parser.add_argument('--hack', help="assemble in memory and write .hack without the intermediate .asm", action="store_true")
+    parser.add_argument('--bin', '-b', help="with --hack, also write a .bin ROM image", action="store_true")
+    parser.add_argument('--peephole', '-p', help="with --hack, run the assembler peephole optimizer", action="store_true")
+    parser.add_argument('--report', '-r', help="with --hack, write ROM size per function (.size.txt/.size.json)", action="store_true")
+    parser.add_argument('--dce', help="with --hack, drop code that no jump or label reference can reach", action="store_true")
+    parser.add_argument('--symbols', '-s', help="with --hack, write the symbol table (.sym) and source map (.map)", action="store_true")
     args = parser.parse_args()
-    Vmtranslator(args.vm_file_or_dir, not args.no_bootstrap).translator()
+    optimize_mode = Str2OptimizeModeMap[args.optimize]
+    pass_options = {InlinePass.name: {"threshold": args.inline_threshold}}
+    pass_manager = PassManager(args.passes.split(","), pass_options) if args.passes else None
+    idiom_statistics = IdiomStatistics() if args.idiom_stats else None
+    if args.hack:
+        peephole_optimizer = PeepholeOptimizer() if args.peephole else None
+        dead_code_eliminator = DeadCodeEliminator() if args.dce else None
+        Vmtranslator(args.vm_file_or_dir, not args.no_bootstrap, optimize=optimize_mode,
+                     pass_manager=pass_manager, idiom_statistics=idiom_statistics, jobs=args.jobs).assemble(
+            write_bin=args.bin, peephole=peephole_optimizer, write_report=args.report,
+            dead_code_eliminator=dead_code_eliminator, write_symbols=args.symbols)
+        if peephole_optimizer:
+            print(peephole_optimizer.report())
+        if dead_code_eliminator:
+            print(dead_code_eliminator.report())
+    else:
+        Vmtranslator(args.vm_file_or_dir, not args.no_bootstrap, optimize=optimize_mode,
+                     pass_manager=pass_manager, idiom_statistics=idiom_statistics, jobs=args.jobs).translator()
+    if pass_manager:
+        print(pass_manager.report(args.time_passes))
+    if idiom_statistics:
+        print(idiom_statistics.report(args.idiom_stats))